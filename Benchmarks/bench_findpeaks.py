@@ -0,0 +1,127 @@
+"""Compare separate find_maxima + find_minima passes against find_extrema.
+
+The separate row runs the original two-pass detectors (find_minima scans a
+negated copy with find_maxima). Passes are counted by a progress callback, as
+the number of scans that report completion. The numpy engine has no progress
+reporting and one detector, so it is only timed.
+
+Run from the project root:
+
+    python Benchmarks/bench_findpeaks.py --samples 100000 1000000
+
+The peaks of both engines are then compared with those of find_maxima and
+find_minima in every edge mode, on the benchmark signals and on short random
+signals with plateaus, integers and NaNs; any difference is reported and makes
+the script exit with 1.
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from Libs.findpeaks import *
+
+from common import make_signal, peak_memory, warm_up
+
+
+class PassCounter():
+    # progress callback counting the scans that reach the end of the signal
+    def __init__(self):
+        self.passes = 0
+
+    def __call__(self, fraction):
+        if fraction >= 1:
+            self.passes += 1
+
+
+def measure(func, *args):
+    counter = PassCounter()
+    progress = ProgressReporter(counter)
+    start = time.perf_counter()
+    result = func(*args, progress)
+    elapsed = time.perf_counter() - start
+    return result, counter.passes, elapsed, peak_memory(func, *args, None)
+
+
+def separate_python(yvalues, tolerance, progress):
+    return find_maxima(yvalues, tolerance, 0, progress), find_minima(yvalues, tolerance, 0, progress)
+
+
+def combined_python(yvalues, tolerance, progress):
+    return find_extrema(yvalues, tolerance, 0, progress)
+
+
+def combined_numpy(yvalues, tolerance, progress):
+    return find_extrema_vectorized(yvalues, tolerance, 0)
+
+
+CASES = [
+    ("python", "separate", separate_python),
+    ("python", "combined", combined_python),
+    ("numpy", "combined", combined_numpy),
+]
+
+
+def random_signal(rng):
+    n_samples = int(rng.integers(0, 60))
+    kind = rng.integers(0, 4)
+    if kind == 0:
+        return rng.normal(size=n_samples)
+    if kind == 1:
+        # integers, with many plateaus and equal peaks
+        return rng.integers(0, 4, size=n_samples)
+    if kind == 2:
+        return np.round(np.sin(np.arange(n_samples) / 3) * 3 + rng.normal(size=n_samples) * 0.5)
+    yvalues = rng.normal(size=n_samples)
+    yvalues[rng.random(n_samples) < 0.2] = np.nan
+    return yvalues
+
+
+def mismatches(yvalues, tolerance):
+    # (engine, edge mode) pairs where an engine differs from find_maxima + find_minima
+    different = []
+    for edge_mode_name, edge_mode in EDGE_MODES.items():
+        expected = (find_maxima(yvalues, tolerance, edge_mode), find_minima(yvalues, tolerance, edge_mode))
+        for engine, found in (("python", find_extrema(yvalues, tolerance, edge_mode)),
+                              ("numpy", find_extrema_vectorized(yvalues, tolerance, edge_mode))):
+            if not all(np.array_equal(np.asarray(a, dtype=int), np.asarray(b, dtype=int))
+                       for a, b in zip(expected, found)):
+                different.append((engine, edge_mode_name))
+    return different
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, nargs="+", default=[10**5, 10**6])
+    parser.add_argument("--tolerance", type=float, default=2.)
+    parser.add_argument("--signals", type=int, default=1000, help="short random signals to compare")
+    args = parser.parse_args()
+
+    warm_up(find_extrema_vectorized, args.tolerance, 0)
+
+    print(f"{'samples':>10} {'engine':>7} {'mode':>9} {'passes':>6} {'time (s)':>9} {'peak MB':>8} {'maxima':>7} {'minima':>7}")
+    for n_samples in args.samples:
+        yvalues = make_signal(n_samples)
+        for engine, mode, func in CASES:
+            (maxima, minima), passes, elapsed, peak = measure(func, yvalues, args.tolerance)
+            passes = passes if engine == "python" else "-"
+            print(f"{n_samples:>10} {engine:>7} {mode:>9} {passes:>6} {elapsed:>9.3f} {peak / 2**20:>8.1f} {len(maxima):>7} {len(minima):>7}")
+
+    failed = 0
+    for n_samples in args.samples:
+        for engine, edge_mode in mismatches(make_signal(n_samples), args.tolerance):
+            print(f"{engine} engine differs from find_maxima/find_minima on {n_samples} samples, {edge_mode} edges")
+            failed += 1
+    rng = np.random.default_rng(0)
+    for _ in range(args.signals):
+        failed += len(mismatches(random_signal(rng), float(rng.choice([0., 0.3, 1., 2.5]))))
+    print(f"{failed} differences from find_maxima/find_minima on {len(args.samples) + args.signals} signals")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""Time utils.make_df against the former dict-based implementation.
+
+Run from the project root:
+
+    python Benchmarks/bench_make_df.py --peaks 100000
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from Libs.utils import make_df
+
+
+def make_df_dicts(xvalues, yvalues, maxima, minima, threshold=10):
+    # make_df before it was rewritten with array operations, kept for comparison
+    xMaxima = [xvalues[p] for p in maxima]
+    yMaxima = [yvalues[p] for p in maxima]
+    xMinima = [xvalues[p] for p in minima]
+    yMinima = [yvalues[p] for p in minima]
+
+    maxima_result = dict(sorted({xMaxima[i]: yMaxima[i] for i in range(len(xMaxima))}.items()))
+    minima_result = dict(sorted({xMinima[i]: yMinima[i] for i in range(len(xMinima))}.items()))
+
+    df_max = pd.DataFrame(list(maxima_result.items()), columns=['X_maxima', 'Y_maxima'])
+    df_max['X_maxima'] = df_max['X_maxima'].astype(int)
+    df_max['Y_maxima'] = df_max['Y_maxima'].astype(float)
+
+    df_min = pd.DataFrame(list(minima_result.items()), columns=['X_minima', 'Y_minima'])
+    df_min['X_minima'] = df_min['X_minima'].astype(int)
+    df_min['Y_minima'] = df_min['Y_minima'].astype(float)
+
+    max_threshold = len(yvalues) - threshold - 1
+    df_max = df_max[(df_max['X_maxima'] >= threshold) & (df_max['X_maxima'] < max_threshold)]
+    df_min = df_min[(df_min['X_minima'] >= threshold) & (df_min['X_minima'] < max_threshold)]
+    return df_max, df_min
+
+
+def best_of(func, args, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--peaks", type=int, nargs="+", default=[10**4, 10**5])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'peaks':>8} {'dicts (s)':>10} {'numpy (s)':>10} {'speed-up':>9} {'same':>5}")
+    for n_peaks in args.peaks:
+        n_samples = 10 * n_peaks
+        xvalues = np.arange(n_samples)
+        yvalues = rng.normal(size=n_samples)
+        # ranked like PeakFinder output: unsorted positions
+        positions = rng.permutation(n_samples)
+        maxima, minima = positions[:n_peaks], positions[n_peaks:2 * n_peaks]
+
+        expected, t_dicts = best_of(make_df_dicts, (xvalues, yvalues, maxima, minima), args.repeat)
+        result, t_numpy = best_of(make_df, (xvalues, yvalues, maxima, minima), args.repeat)
+        same = all(a.equals(b) for a, b in zip(expected, result))
+        print(f"{n_peaks:>8} {t_dicts:>10.4f} {t_numpy:>10.4f} {t_dicts / t_numpy:>8.1f}x {str(same):>5}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Time and peak memory of every stage of the PeakFinder pipeline.
+
+Run from the project root:
+
+    python Benchmarks/bench_pipeline.py
+    python Benchmarks/bench_pipeline.py --samples 1000 100000 --stages detect filter
+
+Signals are sinusoids plus noise. The Excel stages use synthetic workbooks with
+the same layout as the recordings (two header rows, several sheets) and are
+limited to --max-excel-samples rows, since they are orders of magnitude slower
+than the others. Results are compared with Benchmarks/baselines.json, which
+--save-baseline overwrites with the results of the run.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import openpyxl
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from Libs.findpeaks import PeakFinder, filter_peaks
+from Libs.utils import ExcelPeakWriter, WorkbookSession, draw_plot, make_df, save_pictures
+
+from common import make_signal, peak_memory, warm_up
+
+
+BASELINES = Path(__file__).resolve().parent / "baselines.json"
+COLUMN = "Heart Volume_(pL/beat)"
+
+
+def make_workbook(path, n_samples, n_sheets, seed=0):
+    wb = openpyxl.Workbook(write_only=True)
+    for sheet in range(n_sheets):
+        ws = wb.create_sheet(f"Fish {sheet + 1}")
+        ws.append(["Time", "Heart Volume", "Other"])
+        ws.append(["s", "(pL/beat)", None])
+        yvalues = make_signal(n_samples, seed + sheet)
+        for i, value in enumerate(yvalues.tolist()):
+            ws.append([i * 0.01, value, 0.0])
+    wb.save(path)
+
+
+def measure(func):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    return elapsed, peak_memory(func)
+
+
+class Pipeline():
+    # the data every stage of one signal size works on
+    def __init__(self, n_samples, args, workdir):
+        self.n_samples = n_samples
+        self.args = args
+        self.workdir = workdir
+        self.yvalues = make_signal(n_samples)
+        self.xvalues = np.arange(n_samples)
+        _, _, self.maxima, self.minima = PeakFinder(self.yvalues, args.tolerance, engine="numpy")
+        self.df_maxima, self.df_minima = make_df(self.xvalues, self.yvalues, self.maxima, self.minima)
+        self.runs = 0
+        self.excel_path = None
+        if n_samples <= args.max_excel_samples:
+            self.excel_path = os.path.join(workdir, f"signal_{n_samples}.xlsx")
+            make_workbook(self.excel_path, n_samples, args.sheets)
+
+    def output_dir(self):
+        # every run writes into a new directory, so nothing is skipped as already saved
+        self.runs += 1
+        path = os.path.join(self.workdir, f"output_{self.n_samples}_{self.runs}")
+        os.makedirs(path)
+        return path
+
+    def detect(self):
+        PeakFinder(self.yvalues, self.args.tolerance, engine=self.args.engine)
+
+    def filter(self):
+        filter_peaks(self.maxima, self.minima, self.yvalues, self.xvalues, self.args.min_peak_distance, 0., 0.)
+
+    def make_df(self):
+        make_df(self.xvalues, self.yvalues, self.maxima, self.minima)
+
+    def excel_read(self):
+        with WorkbookSession(self.excel_path, max_sheets=0) as session:
+            for sheet_name in session.sheet_names:
+                session.signal(COLUMN, sheet_name)
+
+    def excel_write(self):
+        output_dir = self.output_dir()
+        writer = ExcelPeakWriter(self.excel_path, os.path.join(output_dir, os.path.basename(self.excel_path)))
+        for sheet in range(self.args.sheets):
+            writer.add(f"Fish {sheet + 1}", self.df_maxima, self.df_minima)
+        writer.write()
+
+    def plot(self):
+        figure = draw_plot(self.xvalues, self.yvalues, self.maxima, self.minima)
+        save_pictures(figure, self.output_dir(), "signal.xlsx", "Fish 1")
+
+
+STAGES = ["detect", "filter", "make_df", "excel_read", "excel_write", "plot"]
+EXCEL_STAGES = ["excel_read", "excel_write"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, nargs="+", default=[10**3, 10**4, 10**5, 10**6, 10**7])
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--engine", choices=["python", "numpy"], default="numpy")
+    parser.add_argument("--tolerance", type=float, default=2.)
+    parser.add_argument("--min-peak-distance", type=float, default=50.)
+    parser.add_argument("--sheets", type=int, default=3, help="sheets of the synthetic workbooks")
+    parser.add_argument("--max-excel-samples", type=int, default=10**5)
+    parser.add_argument("--threshold", type=float, default=0.25, help="slow-down reported as a regression")
+    parser.add_argument("--save-baseline", action="store_true")
+    args = parser.parse_args()
+
+    baselines = json.loads(BASELINES.read_text())["results"] if BASELINES.exists() else {}
+    warm_up(PeakFinder, args.tolerance, engine="numpy")
+
+    results = {}
+    regressions = 0
+    print(f"{'samples':>10} {'stage':>11} {'time (s)':>9} {'peak MB':>8} {'baseline':>9} {'ratio':>6}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for n_samples in args.samples:
+            pipeline = Pipeline(n_samples, args, workdir)
+            for stage in args.stages:
+                if stage in EXCEL_STAGES and pipeline.excel_path is None:
+                    continue
+                elapsed, peak = measure(getattr(pipeline, stage))
+                key = f"{stage}:{n_samples}"
+                results[key] = {"time": round(elapsed, 6), "peak_mb": round(peak / 2**20, 2)}
+
+                line = f"{n_samples:>10} {stage:>11} {elapsed:>9.4f} {peak / 2**20:>8.1f}"
+                if key in baselines:
+                    ratio = elapsed / baselines[key]["time"]
+                    line += f" {baselines[key]['time']:>9.4f} {ratio:>6.2f}"
+                    if ratio > 1 + args.threshold:
+                        line += "  slower"
+                        regressions += 1
+                print(line)
+
+    if args.save_baseline:
+        baselines.update(results)
+        BASELINES.write_text(json.dumps({"machine": {"platform": platform.platform(),
+                                                     "python": platform.python_version(),
+                                                     "numpy": np.__version__},
+                                         "results": baselines}, indent=1, sort_keys=True) + "\n")
+        print(f"Saved baselines to {BASELINES}")
+    elif regressions:
+        print(f"{regressions} stages are more than {args.threshold:.0%} slower than the baselines")
+    return 1 if regressions and not args.save_baseline else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,71 @@
+"""Time tolerance_curve against scanning the signal once per tolerance.
+
+Run from the project root:
+
+    python Benchmarks/bench_tolerance.py --samples 100000 1000000
+
+The counts of both are compared on the benchmark signals rounded to integers,
+where many peaks have the same prominence, and on short random quantized
+signals; any difference is reported and makes the script exit with 1.
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from Libs.findpeaks import PeakIndex, estimate_tolerance, tolerance_curve
+
+from common import make_signal, warm_up
+
+
+def scanned_counts(yvalues, tolerances):
+    # what tolerance_curve replaces: one scan of the turning points per tolerance
+    index = PeakIndex(yvalues, max_results=0)
+    return np.array([len(index.find(tolerance, edge_mode="exclude")[0]) for tolerance in tolerances])
+
+
+def random_mismatches(n_signals, seed=0):
+    rng = np.random.default_rng(seed)
+    mismatches = 0
+    for _ in range(n_signals):
+        yvalues = rng.integers(0, 6, size=int(rng.integers(2, 200))).astype(np.float64)
+        tolerances = np.arange(6.)
+        _, counts = tolerance_curve(yvalues, tolerances)
+        mismatches += np.count_nonzero(counts != scanned_counts(yvalues, tolerances))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, nargs="+", default=[10**5, 10**6])
+    parser.add_argument("--signals", type=int, default=1000, help="short random signals to compare")
+    args = parser.parse_args()
+
+    warm_up(tolerance_curve)
+
+    print(f"{'samples':>10} {'tolerances':>10} {'curve (s)':>10} {'scans (s)':>10} {'estimate':>9} {'same':>5}")
+    failed = False
+    for n_samples in args.samples:
+        yvalues = make_signal(n_samples, quantized=True)
+        start = time.perf_counter()
+        tolerances, counts = tolerance_curve(yvalues)
+        t_curve = time.perf_counter() - start
+        start = time.perf_counter()
+        expected = scanned_counts(yvalues, tolerances)
+        t_scans = time.perf_counter() - start
+        same = np.array_equal(counts, expected)
+        failed |= not same
+        print(f"{n_samples:>10} {len(tolerances):>10} {t_curve:>10.4f} {t_scans:>10.4f} "
+              f"{estimate_tolerance(yvalues):>9.3f} {str(same):>5}")
+
+    mismatches = random_mismatches(args.signals)
+    print(f"{mismatches} different counts on {args.signals} random quantized signals")
+    return 1 if failed or mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,30 @@
+"""Signals and measurements shared by the benchmark scripts.
+
+The scripts run from the project root as python Benchmarks/<script>.py, which
+puts this folder on sys.path, so they import it as a plain module.
+"""
+import tracemalloc
+
+import numpy as np
+
+
+def make_signal(n_samples, seed=0, quantized=False):
+    # a sinusoid plus noise, rounded to integers when quantized so many peaks share a prominence
+    rng = np.random.default_rng(seed)
+    x = np.arange(n_samples)
+    yvalues = np.sin(x / 200) * 5 + rng.normal(size=n_samples)
+    return np.round(yvalues) if quantized else yvalues
+
+
+def warm_up(func, *args, **kwargs):
+    # compile the optional numba kernels outside of the measurements
+    return func(make_signal(100), *args, **kwargs)
+
+
+def peak_memory(func, *args):
+    # tracemalloc slows the interpreted loops down, so memory gets its own run
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
@@ -0,0 +1,184 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from Libs.utils import PLOT_DPI, PLOT_SIZE, draw_plot, open_session, save_pictures
+from Libs.findpeaks import (EDGE_MODES, PeakFinder, PeakFinderStream, PeakResult, ProgressReporter,
+                            estimate_tolerance, iter_chunks, resolve_edge_mode)
+from Libs.instrument import set_context
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+# workbooks and signal files opened by this process, reused by the next sheets of the same file
+_sessions = {}
+
+
+def get_session(excel_path, signal_options=None, max_open=2):
+    if excel_path not in _sessions:
+        while len(_sessions) >= max_open:
+            _sessions.pop(next(iter(_sessions))).close()
+        # every sheet is analyzed once, so parsed sheets are not cached
+        _sessions[excel_path] = open_session(excel_path, max_sheets=0, **(signal_options or {}))
+    return _sessions[excel_path]
+
+
+# samples of a memory-mapped signal read at a time by find_peaks
+STREAM_CHUNK_SIZE = 1 << 16
+
+
+def find_peaks(yvalues, params):
+    # Memory-mapped signals are streamed through PeakFinderStream, which finds
+    # the same peaks without any array as long as the signal; only circular
+    # edges need the whole signal at once
+    edge_mode = resolve_edge_mode(params.get("excludeOnEdges", False), params.get("edge_mode"))
+    if isinstance(yvalues, np.memmap) and edge_mode != EDGE_MODES["circular"]:
+        stream_params = {name: value for name, value in params.items() if name != "engine"}
+        _, maxima, minima = PeakFinderStream(iter_chunks(yvalues, STREAM_CHUNK_SIZE), **stream_params)
+        return PeakResult.from_peaks(yvalues, maxima, minima)
+    return PeakFinder(yvalues, **params, as_result=True)
+
+
+def analyze_sheet(excel_path, sheet_name, column_name, params, signal_options=None, cache=None):
+    # runs in a worker process, so it only receives and returns picklable data
+    set_context(file=os.path.basename(excel_path), sheet=sheet_name)
+    yvalues = get_session(excel_path, signal_options).signal(column_name, sheet_name)
+
+    params = dict(params)
+    tolerance_method = params.pop("tolerance_method", "std")
+    if params.get("tolerance") is None:
+        # estimated on each signal, see estimate_tolerance
+        params["tolerance"] = estimate_tolerance(yvalues, tolerance_method)
+
+    key = cache.key(yvalues, params) if cache is not None else None
+    peaks = cache.get(key) if cache is not None else None
+    if peaks is not None:
+        logger.info(f"Loaded the peaks of sheet {sheet_name} of {excel_path} from the cache")
+    else:
+        peaks = find_peaks(yvalues, params)
+        if cache is not None:
+            cache.put(key, peaks)
+
+    return {"excel_path": excel_path,
+            "sheet_name": sheet_name,
+            "column_name": column_name,
+            "tolerance": params["tolerance"],
+            # memory-mapped signals are mapped again by run_batch instead of being copied back
+            "yvalues": None if isinstance(yvalues, np.memmap) else yvalues,
+            "peaks": peaks}
+
+
+def run_batch(jobs, column_name, params, max_workers=None, progress=None, on_result=None, signal_options=None,
+              cache=None):
+    # Analyze every (excel_path, sheet_name) job in a process pool. on_result is
+    # called in the calling thread as soon as each sheet is done, so results can
+    # be saved while the remaining sheets are still being analyzed.
+    # signal_options (dtype, n_columns, offset) are used to open raw binary files,
+    # and the peaks of unchanged signals are taken from cache (a ResultCache).
+    if not isinstance(progress, ProgressReporter):
+        progress = ProgressReporter(progress)
+    results = []
+    failed = []
+    if len(jobs) == 0:
+        progress.report(1)
+        return results, failed
+
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    max_workers = max(1, min(int(max_workers), len(jobs)))
+    logger.info(f"Analyzing {len(jobs)} sheets with {max_workers} workers")
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(analyze_sheet, excel_path, sheet_name, column_name, params, signal_options, cache): (excel_path, sheet_name)
+                   for excel_path, sheet_name in jobs}
+        for done, future in enumerate(as_completed(futures), start=1):
+            excel_path, sheet_name = futures[future]
+            try:
+                result = future.result()
+                if result["yvalues"] is None:
+                    result["yvalues"] = get_session(excel_path, signal_options).signal(column_name, sheet_name)
+                logger.info(f"Found {len(result['peaks'].maxima)} maxima and {len(result['peaks'].minima)} minima in sheet {sheet_name} of {excel_path}")
+                if on_result is not None:
+                    on_result(result)
+            except Exception as e:
+                logger.error(f"Failed to process sheet {sheet_name} of {excel_path}: {e}")
+                failed.append((excel_path, sheet_name, e))
+            else:
+                results.append(result)
+            progress.report(done / len(jobs))
+
+    return results, failed
+
+
+# the figure this worker process draws every plot on
+_figure = None
+
+
+def export_plot(result, output_dir, figsize, dpi, signal_options=None):
+    # runs in a PlotExporter worker process
+    global _figure
+    set_context(file=os.path.basename(result["excel_path"]), sheet=result["sheet_name"])
+    yvalues = result["yvalues"]
+    if yvalues is None:
+        # memory-mapped signals are mapped again here instead of being pickled
+        yvalues = get_session(result["excel_path"], signal_options).signal(result["column_name"], result["sheet_name"])
+    peaks = result["peaks"]
+    _figure = draw_plot(None, yvalues, peaks.maxima, peaks.minima,
+                        figsize=figsize, dpi=dpi, figure=_figure)
+    try:
+        return save_pictures(_figure, output_dir, os.path.basename(result["excel_path"]), result["sheet_name"], dpi=dpi)
+    finally:
+        # drop the artists so the worker does not keep the last signal alive
+        _figure.clear()
+
+
+class PlotExporter():
+    """Saves the peak plots of finished sheets in a separate process pool.
+
+    Rendering then overlaps with the detection of the next sheets instead of
+    running after each of them. close() waits for the pending plots and
+    returns the failed ones as (excel_path, sheet_name, exception).
+    Memory-mapped signals are opened again by the workers, with the
+    ``signal_options`` given to run_batch.
+    """
+
+    def __init__(self, output_dir, max_workers=None, figsize=PLOT_SIZE, dpi=PLOT_DPI, signal_options=None):
+        if max_workers is None:
+            max_workers = max(1, (os.cpu_count() or 1) // 2)
+        self.output_dir = output_dir
+        self.figsize = figsize
+        self.dpi = dpi
+        self.signal_options = signal_options
+        self.executor = ProcessPoolExecutor(max_workers=max_workers)
+        self.futures = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, result):
+        plot = {key: result[key] for key in ("excel_path", "sheet_name", "column_name", "yvalues", "peaks")}
+        if isinstance(plot["yvalues"], np.memmap):
+            plot["yvalues"] = None
+        future = self.executor.submit(export_plot, plot, self.output_dir, self.figsize, self.dpi, self.signal_options)
+        self.futures[future] = (result["excel_path"], result["sheet_name"])
+        return future
+
+    def close(self):
+        failed = []
+        for future in as_completed(self.futures):
+            excel_path, sheet_name = self.futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Failed to save the plot of sheet {sheet_name} of {excel_path}: {e}")
+                failed.append((excel_path, sheet_name, e))
+        self.futures = {}
+        self.executor.shutdown()
+        return failed
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import logging
+import os
+import zipfile
+
+import numpy as np
+
+from Libs.findpeaks import PeakResult, iter_chunks
+
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+# bump when a change to the detection changes its results, so older entries are not used
+CACHE_VERSION = 4
+
+
+class ResultCache():
+    """Peaks found on a signal, stored on disk and keyed by a hash of the
+    signal and of the PeakFinder parameters.
+
+    Every entry is a small .npz file holding the arrays of a PeakResult. The
+    least recently used entries are deleted once the directory grows over
+    ``max_bytes``. Entries are written atomically, so several batch workers can
+    share the same directory; an entry deleted by one of them is just a miss.
+    """
+    def __init__(self, cache_dir="Cache", max_bytes=512 * 2**20):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, yvalues, params):
+        # the engines give the same peaks, so the engine is not part of the key
+        params = {name: value for name, value in params.items() if name not in ("engine", "progress", "index")}
+        yvalues = np.asanyarray(yvalues)
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(json.dumps([CACHE_VERSION, str(yvalues.dtype), yvalues.shape,
+                                  sorted((name, str(value)) for name, value in params.items())]).encode())
+        # hashed in chunks, so a strided column of a memory-mapped file is
+        # never copied whole
+        for chunk in iter_chunks(yvalues):
+            digest.update(np.ascontiguousarray(chunk).data)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                peaks = PeakResult.from_dict(entry)
+            # entries are evicted by last use
+            os.utime(path)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+        return peaks
+
+    def put(self, key, peaks):
+        path = self.path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.savez(f, **peaks.to_dict())
+        os.replace(temp_path, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".npz"):
+                os.remove(entry.path)
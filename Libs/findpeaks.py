@@ -1,33 +1,376 @@
 import numpy as np
+from collections import OrderedDict
+import time
 
-def PeakFinder(progress_bar,
-               yvalues,
+from Libs.instrument import stage
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def compile_kernel(func):
+    # func compiled with numba, or None when numba is not installed
+    return None if njit is None else njit(cache=True)(func)
+
+
+def run_kernel(kernel, func, inputs, outputs=()):
+    # Calls kernel (see compile_kernel) on the inputs and the output arrays it
+    # fills in place. Without numba, func runs instead on plain lists, which
+    # are much faster than numpy scalars in an interpreted loop, and the
+    # outputs are copied back. Returns what the kernel returns.
+    if kernel is not None:
+        return kernel(*inputs, *outputs)
+    found = [output.tolist() for output in outputs]
+    result = func(*[arg.tolist() if isinstance(arg, np.ndarray) else arg for arg in inputs], *found)
+    for output, items in zip(outputs, found):
+        output[:] = items
+    return result
+
+
+ENGINES = ["python", "numpy"]
+EDGE_MODES = {"include": 0, "exclude": 1, "circular": 2}
+
+
+class ProgressReporter():
+    """Throttled progress reporting for the peak detection loops.
+
+    ``callback(fraction)`` receives a value between 0 and 1, at most ``updates``
+    times per scan and, if ``interval`` is given, at most once every
+    ``interval`` seconds. Without a callback every report is a no-op.
+    """
+    def __init__(self, callback=None, updates=100, interval=None):
+        self.callback = callback
+        self.updates = max(1, int(updates))
+        self.interval = interval
+        self._last_time = None
+
+    def step(self, total):
+        # number of samples between two reports
+        if self.callback is None:
+            return total + 1
+        return max(1, total // self.updates)
+
+    def report(self, fraction):
+        if self.callback is None:
+            return
+        if self.interval is not None and fraction < 1:
+            now = time.monotonic()
+            if self._last_time is not None and now - self._last_time < self.interval:
+                return
+            self._last_time = now
+        self.callback(fraction)
+
+
+# one row per peak of PeakFinderBatch; kind is 1 for maxima and -1 for minima
+PEAK_DTYPE = np.dtype([("signal", np.int32),
+                       ("kind", np.int8),
+                       ("position", np.int64),
+                       ("value", np.float64)])
+
+
+# per-peak arrays of peak_shapes, stored in PeakResult
+SHAPE_FIELDS = ("prominence", "base_height", "left_base", "right_base", "width")
+
+
+class PeakResult():
+    """Peaks found on one signal, as contiguous arrays with one row per peak.
+
+    ``positions`` (int64), ``values`` (float64) and ``kind`` (int8, 1 for
+    maxima and -1 for minima) keep these dtypes whichever filters ran. Maxima
+    come before minima, each in the rank order of PeakFinder. The x values of
+    the signal are its sample numbers, so only its length ``n_samples`` is
+    kept. Results pickle as a few flat buffers and to_dict gives arrays for
+    np.savez.
+
+    With PeakFinder(..., shapes=True), ``prominence``, ``base_height`` and
+    ``width`` (float64, NaN otherwise) and ``left_base`` and ``right_base``
+    (int64, -1 otherwise) are filled in too, see peak_shapes. ``prominence``
+    is the usual topographic prominence. ``base_height`` and the bases only
+    look as far as the neighbouring detected peaks.
+    """
+    __slots__ = ("positions", "values", "prominence", "kind", "n_samples", "left_base", "right_base", "width",
+                 "base_height")
+
+    def __init__(self, positions, values, kind, prominence=None, n_samples=0,
+                 left_base=None, right_base=None, width=None, base_height=None):
+        self.positions = np.ascontiguousarray(positions, dtype=np.int64)
+        self.values = np.ascontiguousarray(values, dtype=np.float64)
+        self.kind = np.ascontiguousarray(kind, dtype=np.int8)
+        size = len(self.positions)
+        self.prominence = np.ascontiguousarray(np.full(size, np.nan) if prominence is None else prominence,
+                                               dtype=np.float64)
+        self.n_samples = int(n_samples)
+        self.left_base = np.ascontiguousarray(np.full(size, -1) if left_base is None else left_base, dtype=np.int64)
+        self.right_base = np.ascontiguousarray(np.full(size, -1) if right_base is None else right_base, dtype=np.int64)
+        self.width = np.ascontiguousarray(np.full(size, np.nan) if width is None else width, dtype=np.float64)
+        self.base_height = np.ascontiguousarray(np.full(size, np.nan) if base_height is None else base_height,
+                                                dtype=np.float64)
+
+    @classmethod
+    def from_peaks(cls, yvalues, maxima, minima, shapes=None):
+        # maxima and minima as returned by PeakFinder; shapes are the
+        # peak_shapes of every maximum and minimum found by the scan
+        maxima = np.asarray(maxima, dtype=np.int64)
+        minima = np.asarray(minima, dtype=np.int64)
+        positions = np.concatenate([maxima, minima])
+        kind = np.repeat(np.array([1, -1], dtype=np.int8), [len(maxima), len(minima)])
+        result = cls(positions, np.asarray(yvalues)[positions], kind, n_samples=len(yvalues))
+        if shapes is not None:
+            for mask, peaks, shape in ((kind == 1, maxima, shapes[0]), (kind == -1, minima, shapes[1])):
+                # the filters only drop peaks, so every kept one has a row
+                rows = np.searchsorted(shape["positions"], peaks)
+                for name in SHAPE_FIELDS:
+                    getattr(result, name)[mask] = shape[name][rows]
+        return result
+
+    @classmethod
+    def from_dict(cls, arrays):
+        return cls(arrays["positions"], arrays["values"], arrays["kind"], arrays["prominence"],
+                   arrays["n_samples"], arrays["left_base"], arrays["right_base"], arrays["width"],
+                   arrays["base_height"])
+
+    @classmethod
+    def merge(cls, results, offsets=None):
+        # Peaks of consecutive parts of one signal, found separately (e.g. by
+        # several workers), as one result ranked again. offsets are the first
+        # sample of every part, by default the parts follow each other.
+        results = list(results)
+        if len(results) == 0:
+            return cls([], [], [])
+        if offsets is None:
+            offsets = np.cumsum([0] + [result.n_samples for result in results[:-1]])
+        positions = np.concatenate([result.positions + offset for result, offset in zip(results, offsets)])
+        values = np.concatenate([result.values for result in results])
+        kind = np.concatenate([result.kind for result in results])
+        prominence = np.concatenate([result.prominence for result in results])
+        width = np.concatenate([result.width for result in results])
+        base_height = np.concatenate([result.base_height for result in results])
+        # bases that were not computed stay at -1
+        left_base = np.concatenate([np.where(result.left_base < 0, -1, result.left_base + offset)
+                                    for result, offset in zip(results, offsets)])
+        right_base = np.concatenate([np.where(result.right_base < 0, -1, result.right_base + offset)
+                                     for result, offset in zip(results, offsets)])
+        n_samples = max(offset + result.n_samples for result, offset in zip(results, offsets))
+        # maxima by descending value, then minima by ascending value
+        order = np.lexsort((-kind * values, -kind))
+        return cls(positions[order], values[order], kind[order], prominence[order], n_samples,
+                   left_base[order], right_base[order], width[order], base_height[order])
+
+    def to_dict(self):
+        return {"positions": self.positions,
+                "values": self.values,
+                "kind": self.kind,
+                "prominence": self.prominence,
+                "n_samples": np.int64(self.n_samples),
+                "left_base": self.left_base,
+                "right_base": self.right_base,
+                "width": self.width,
+                "base_height": self.base_height}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __repr__(self):
+        return f"PeakResult({np.count_nonzero(self.kind == 1)} maxima, {np.count_nonzero(self.kind == -1)} minima, n_samples={self.n_samples})"
+
+    @property
+    def maxima(self):
+        return self.positions[self.kind == 1]
+
+    @property
+    def minima(self):
+        return self.positions[self.kind == -1]
+
+
+def PeakFinder(yvalues,
                tolerance,
                minPeakDistance = 0,
                minMaximaValue = np.nan,
                maxMaximaValue = np.nan,
                excludeOnEdges = False,
+               engine = "python",
+               progress = None,
+               edge_mode = None,
+               index = None,
+               as_result = False,
+               shapes = False,
             ):
+    # index is an optional PeakIndex of yvalues, which answers repeated calls
+    # on the same signal with other parameters without scanning it again.
+    # With as_result, a PeakResult is returned instead of the tuple, and the x
+    # values are never allocated. shapes also fills in the base height, bases
+    # and width of every peak in that PeakResult (see peak_shapes). They are
+    # measured on the turning points of a PeakIndex, so with shapes the peaks
+    # always come from the numpy engine's scan, whatever engine is given (both
+    # engines find the same peaks).
 
-    xvalues = np.arange(len(yvalues))
+    check_engine(engine)
+    if not isinstance(progress, ProgressReporter):
+        progress = ProgressReporter(progress)
+    edge_mode = resolve_edge_mode(excludeOnEdges, edge_mode)
 
-    # tolerance = np.std(yvalues)
+    if shapes:
+        if not as_result:
+            raise ValueError("Peak shapes are only returned in a PeakResult, use as_result=True")
+        if index is None:
+            index = PeakIndex(yvalues, max_results=1)
+        maxima, minima = index.find(tolerance, minPeakDistance, minMaximaValue, maxMaximaValue, edge_mode=edge_mode)
+        progress.report(1)
+        return PeakResult.from_peaks(yvalues, maxima, minima, index.shapes(tolerance, edge_mode))
 
-    maxima = find_maxima(yvalues, tolerance, excludeOnEdges, progress_bar)
-    minima = find_minima(yvalues, tolerance, excludeOnEdges, progress_bar)
+    if index is not None:
+        maxima, minima = index.find(tolerance, minPeakDistance, minMaximaValue, maxMaximaValue, edge_mode=edge_mode)
+        progress.report(1)
+        if as_result:
+            return PeakResult.from_peaks(yvalues, maxima, minima)
+        return np.arange(len(yvalues)), yvalues, maxima, minima
 
-    if minMaximaValue is not np.nan:
-        maxima = trim_peak_height(yvalues, maxima, False)
-    if maxMaximaValue is not np.nan:
-        minima = trim_peak_height(yvalues, minima, True)
-    if minPeakDistance > 0:
-        maxima = trim_peak_distance(maxima, xvalues, minPeakDistance)
-        minima = trim_peak_distance(minima, xvalues, minPeakDistance)
+    # x values are the sample numbers, which filter_peaks uses when xvalues is None
+    xvalues = None if as_result else np.arange(len(yvalues))
 
+    # tolerance = np.std(yvalues)
+
+    maxima, minima = detect_peaks(yvalues, xvalues, tolerance, minPeakDistance, minMaximaValue,
+                                  maxMaximaValue, edge_mode, engine, progress)
+
+    if as_result:
+        return PeakResult.from_peaks(yvalues, maxima, minima)
     return xvalues, yvalues, maxima, minima
 
 
-def find_maxima(xx, tolerance, edge_mode, progress_bar):
+def PeakFinderBatch(signals,
+                    tolerance,
+                    minPeakDistance = 0,
+                    minMaximaValue = np.nan,
+                    maxMaximaValue = np.nan,
+                    excludeOnEdges = False,
+                    engine = "numpy",
+                    progress = None,
+                    edge_mode = None,
+                    ):
+    # Run PeakFinder with shared parameters over every column of a 2-D array or
+    # DataFrame. Returns the column names and a PEAK_DTYPE array ordered by
+    # signal, then maxima before minima, then position.
+    check_engine(engine)
+    if not isinstance(progress, ProgressReporter):
+        progress = ProgressReporter(progress)
+    edge_mode = resolve_edge_mode(excludeOnEdges, edge_mode)
+
+    if hasattr(signals, "columns"):
+        names = list(signals.columns)
+        signals = signals.to_numpy(dtype=np.float64)
+    else:
+        signals = np.asarray(signals)
+        if signals.ndim == 1:
+            signals = signals[:, np.newaxis]
+        names = list(range(signals.shape[1]))
+    if signals.ndim != 2:
+        raise ValueError(f"Expected a 1-D or 2-D array of signals, got {signals.ndim} dimensions")
+    # contiguous columns, converted once for all signals
+    signals = np.asfortranarray(signals, dtype=np.float64)
+
+    xvalues = np.arange(signals.shape[0])
+    n_signals = signals.shape[1]
+    chunks = []
+    for ii in range(n_signals):
+        yvalues = signals[:, ii]
+        maxima, minima = detect_peaks(yvalues, xvalues, tolerance, minPeakDistance, minMaximaValue,
+                                      maxMaximaValue, edge_mode, engine, None)
+        for kind, positions in ((1, maxima), (-1, minima)):
+            positions = np.sort(np.asarray(positions, dtype=np.int64))
+            chunk = np.empty(len(positions), dtype=PEAK_DTYPE)
+            chunk["signal"] = ii
+            chunk["kind"] = kind
+            chunk["position"] = positions
+            chunk["value"] = yvalues[positions]
+            chunks.append(chunk)
+        progress.report((ii + 1) / n_signals)
+
+    peaks = np.concatenate(chunks) if chunks else np.empty(0, dtype=PEAK_DTYPE)
+    return names, peaks
+
+
+def PeakFinderStream(chunks,
+                     tolerance,
+                     minPeakDistance = 0,
+                     minMaximaValue = np.nan,
+                     maxMaximaValue = np.nan,
+                     excludeOnEdges = False,
+                     edge_mode = None,
+                     ):
+    # PeakFinder over a signal given as an iterable of 1-D chunks (see
+    # iter_chunks), which is never held in memory as a whole. Returns the
+    # number of samples and the same maxima and minima as PeakFinder.
+    finder = StreamingPeakFinder(tolerance, excludeOnEdges, edge_mode)
+    # the peaks of every chunk are kept as arrays, which take a fraction of
+    # the memory of the (position, value) tuples
+    found = {False: [], True: []}
+    for chunk in chunks:
+        for minima, peaks in enumerate(finder.update(chunk)):
+            found[bool(minima)].append(peak_arrays(peaks))
+    for minima, peaks in enumerate(finder.finish()):
+        found[bool(minima)].append(peak_arrays(peaks))
+
+    maxima = filter_ranked_peaks(*rank_peaks(found[False], False), minMaximaValue, minPeakDistance, False)
+    minima = filter_ranked_peaks(*rank_peaks(found[True], True), maxMaximaValue, minPeakDistance, True)
+    return finder.n_samples, maxima, minima
+
+
+def iter_chunks(yvalues, chunk_size=1 << 20):
+    # slices of any array-like, e.g. a np.memmap or np.load(..., mmap_mode="r"),
+    # so only one chunk is read into memory at a time
+    for start in range(0, len(yvalues), chunk_size):
+        yield np.asarray(yvalues[start:start + chunk_size])
+
+
+def check_engine(engine):
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
+
+
+def resolve_edge_mode(excludeOnEdges, edge_mode):
+    # edge_mode overrides excludeOnEdges, which can only pick include/exclude
+    if edge_mode is None:
+        return EDGE_MODES["exclude"] if excludeOnEdges else EDGE_MODES["include"]
+    if isinstance(edge_mode, str):
+        if edge_mode not in EDGE_MODES:
+            raise ValueError(f"Unknown edge_mode {edge_mode!r}, expected one of {list(EDGE_MODES)}")
+        return EDGE_MODES[edge_mode]
+    return edge_mode
+
+
+def detect_peaks(yvalues, xvalues, tolerance, minPeakDistance, minMaximaValue, maxMaximaValue,
+                 edge_mode, engine, progress):
+    with stage("detect", samples=len(yvalues), engine=engine) as record:
+        if engine == "numpy":
+            maxima, minima = find_extrema_vectorized(yvalues, tolerance, edge_mode)
+            if progress is not None:
+                progress.report(1)
+        else:
+            maxima, minima = find_extrema(yvalues, tolerance, edge_mode, progress)
+        record["maxima"] = len(maxima)
+        record["minima"] = len(minima)
+    return filter_peaks(maxima, minima, yvalues, xvalues, minPeakDistance, minMaximaValue, maxMaximaValue)
+
+
+def filter_peaks(maxima, minima, yvalues, xvalues, minPeakDistance, minMaximaValue, maxMaximaValue):
+    with stage("filter", maxima=len(maxima), minima=len(minima)) as record:
+        # minMaximaValue keeps maxima above it, maxMaximaValue keeps minima below it
+        if not np.isnan(minMaximaValue):
+            maxima = trim_peak_height(maxima, yvalues, minMaximaValue, minima=False)
+        if not np.isnan(maxMaximaValue):
+            minima = trim_peak_height(minima, yvalues, maxMaximaValue, minima=True)
+        if minPeakDistance > 0:
+            maxima = trim_peak_distance(maxima, xvalues, minPeakDistance)
+            minima = trim_peak_distance(minima, xvalues, minPeakDistance)
+        record["kept_maxima"] = len(maxima)
+        record["kept_minima"] = len(minima)
+        return maxima, minima
+
+
+def find_maxima(xx, tolerance, edge_mode, progress=None):
     INCLUDE_EDGE = 0
     CIRCULAR = 2
     len_x = len(xx)
@@ -37,13 +380,8 @@ def find_maxima(xx, tolerance, edge_mode, progress_bar):
     if tolerance < 0:
         tolerance = 0
     if edge_mode == CIRCULAR:
-        cascade3 = np.empty(len_x * 3)
-        for jj in range(len_x):
-            cascade3[jj] = xx[jj]
-            cascade3[jj + len_x] = xx[jj]
-            cascade3[jj + 2*len_x] = xx[jj]
+        # scan three turns of the ring (jj % orig_len) instead of a 3x copy
         len_x *= 3
-        xx = cascade3
     max_positions = np.zeros(len_x, dtype=int)
     max_val = xx[0]
     min_val = xx[0]
@@ -51,10 +389,13 @@ def find_maxima(xx, tolerance, edge_mode, progress_bar):
     last_max_pos = -1
     left_valley_found = (edge_mode == INCLUDE_EDGE)
     max_count = 0
+    report_every = progress.step(len_x) if progress is not None else len_x
+    next_report = report_every
     for jj in range(1, len_x):
-        progress_bar['value'] = (jj + 1) / len_x * 100
-        progress_bar.update()
-        val = xx[jj]
+        if jj == next_report:
+            progress.report(jj / len_x)
+            next_report += report_every
+        val = xx[jj % orig_len]
         if val > min_val + tolerance:
             left_valley_found = True
         if val > max_val and left_valley_found:
@@ -79,17 +420,19 @@ def find_maxima(xx, tolerance, edge_mode, progress_bar):
         elif max_count == 0 and max_val - min_val >= tolerance:
             max_positions[max_count] = last_max_pos
             max_count += 1
+    if progress is not None:
+        progress.report(1)
     cropped = max_positions[:max_count]
     max_positions = cropped
     max_values = np.empty(max_count)
     for jj in range(max_count):
         pos = max_positions[jj]
         mid_pos = pos
-        while pos < len_x - 1 and xx[pos] == xx[pos + 1]:
+        while pos < len_x - 1 and xx[pos % orig_len] == xx[(pos + 1) % orig_len]:
             mid_pos += 0.5
             pos += 1
         max_positions[jj] = int(mid_pos)
-        max_values[jj] = xx[max_positions[jj]]
+        max_values[jj] = xx[max_positions[jj] % orig_len]
     rank_positions = np.argsort(max_values)
     return_arr = np.empty(max_count, dtype=int)
     for jj in range(max_count):
@@ -105,44 +448,904 @@ def find_maxima(xx, tolerance, edge_mode, progress_bar):
         return_arr = return_arr[:count]
     return return_arr
 
-def find_minima(xx, tolerance, edge_mode, progress_bar):
+def find_minima(xx, tolerance, edge_mode, progress=None):
     len_x = len(xx)
     neg_arr = [-x for x in xx]
-    min_positions = find_maxima(neg_arr, tolerance, edge_mode, progress_bar)
+    min_positions = find_maxima(neg_arr, tolerance, edge_mode, progress)
     return min_positions
 
 
-def trim_peak_height(positions, minima, yvalues):
-    size1 = len(positions)
-    size2 = 0
-    for i in range(size1):
-        if filtered_height(yvalues[positions[i]], minima):
-            size2 += 1
+def trim_peak_height(positions, yvalues, threshold, minima):
+    # positions are sorted by amplitude, so the peaks passing the threshold form
+    # a prefix whose end is found with a binary search
+    positions = np.asarray(positions, dtype=int)
+    lo = 0
+    hi = len(positions)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if filtered_height(yvalues[positions[mid]], threshold, minima):
+            lo = mid + 1
         else:
-            break  # positions are sorted by amplitude
-    newpositions = [positions[i] for i in range(size2)]
-    return newpositions
+            hi = mid
+    return positions[:lo]
 
-def filtered_height(height, minima, max_minima_value, min_maxima_value):
+def filtered_height(height, threshold, minima):
     if minima:
-        return height < max_minima_value
+        return height < threshold
     else:
-        return height > min_maxima_value
+        return height > threshold
 
 def trim_peak_distance(positions, xvalues, min_peak_distance):
+    # A peak is dropped when any more prominent peak (lower rank, since positions
+    # are sorted by amplitude) lies closer than min_peak_distance. Instead of
+    # comparing every pair, sort the peaks by x and look up the best rank inside
+    # each peak's window with a range-minimum query. xvalues None stands for
+    # the sample numbers.
+    positions = np.asarray(positions, dtype=int)
     size = len(positions)
-    temp = [0 for _ in range(size)]
-    newsize = 0
-    for i in range(size - 1, -1, -1):
-        pos1 = positions[i]
-        trim = False
-        for j in range(i - 1, -1, -1):
-            pos2 = positions[j]
-            if abs(xvalues[pos2] - xvalues[pos1]) < min_peak_distance:
-                trim = True
+    if size == 0:
+        return positions
+    x = positions if xvalues is None else np.asarray(xvalues)[positions]
+    order = np.argsort(x, kind='stable')
+    sorted_x = x[order]
+    lo = np.searchsorted(sorted_x, sorted_x - min_peak_distance, side='right')
+    hi = np.searchsorted(sorted_x, sorted_x + min_peak_distance, side='left')
+    # the window always contains the peak itself, so it survives only if it is
+    # the best ranked peak of its window
+    best_rank = window_minimum(order, lo, hi)
+    keep = np.empty(size, dtype=bool)
+    keep[order] = best_rank == order
+    # least prominent first, like the original pairwise implementation
+    return positions[keep][::-1]
+
+
+def window_minimum(values, lo, hi):
+    # min(values[lo[i]:hi[i]]) for every i (hi > lo), using a sparse table
+    # where table[level][j] = min(values[j:j + 2**level]), up to the level of
+    # the widest window
+    table = [values]
+    span = 1
+    widest = int(np.max(hi - lo)) if len(lo) > 0 else 1
+    while 2 * span <= widest:
+        previous = table[-1]
+        table.append(np.minimum(previous[:-span], previous[span:]))
+        span *= 2
+    levels = np.frexp(hi - lo)[1] - 1
+    result = np.empty(len(lo), dtype=values.dtype)
+    for level in np.unique(levels):
+        mask = levels == level
+        row = table[level]
+        result[mask] = np.minimum(row[lo[mask]], row[hi[mask] - (1 << level)])
+    return result
+
+
+# turns of a circular scan are compared every RING_CHECKPOINT samples (or
+# turning points), see same_ring_state
+RING_CHECKPOINT = 4096
+
+
+def same_ring_state(values, flags, previous_values, previous_flags, shift):
+    # True when the state of a circular scan (as in scan_state) repeats the one
+    # it had a turn earlier, from where the rest of the scan repeats that turn
+    # shift samples later. A peak position is only compared while its peak is
+    # tracked: otherwise it is replaced before the next peak is confirmed.
+    if list(values) != list(previous_values) or list(flags[4:]) != list(previous_flags[4:]):
+        return False
+    if flags[4] and flags[0] != previous_flags[0] + shift:
+        return False
+    if flags[5] and flags[1] != previous_flags[1] + shift:
+        return False
+    return True
+
+
+def repeat_turns(positions, counts, sync, period, end, shift):
+    # Positions a circular scan up to time end would confirm, from those of a
+    # scan stopped at time sync where same_ring_state held: afterwards it
+    # confirms the positions of the previous turn again, shift later every
+    # period. counts[time] is the number of positions confirmed before each
+    # checkpoint time, turn ends included.
+    positions = np.asarray(positions, dtype=np.int64)[:counts[sync]]
+    window = positions[counts[sync - period]:]
+    copies = [positions]
+    turn = 1
+    while sync + (turn - 1) * period < end:
+        stop = min(sync + turn * period, end)
+        copies.append(window[:counts[stop - turn * period] - counts[sync - period]] + turn * shift)
+        turn += 1
+    return np.concatenate(copies)
+
+
+def find_extrema(xx, tolerance, edge_mode, progress=None):
+    # find_maxima and find_minima in a single traversal: the minima state
+    # machine is the maxima one mirrored (hi_val/lo_val play the role of
+    # -min_val/-max_val), so no negated copy of the signal is needed
+    INCLUDE_EDGE = 0
+    CIRCULAR = 2
+    xx = np.asarray(xx)
+    orig_len = len(xx)
+    if orig_len < 2:
+        return [], []
+    if tolerance < 0:
+        tolerance = 0
+    circular = edge_mode == CIRCULAR
+    # A circular scan reads the ring (jj % orig_len) for up to three turns,
+    # but stops at the first checkpoint where a turn repeats the previous one
+    len_x = 3 * orig_len if circular else orig_len
+    checkpoint = RING_CHECKPOINT if circular else orig_len
+    max_positions = []
+    min_positions = []
+    max_counts = {}
+    min_counts = {}
+    snapshots = {}
+    max_val = min_val = hi_val = lo_val = xx[0]
+    max_pos = min_pos = 0
+    last_max_pos = last_min_pos = -1
+    left_valley_found = left_peak_found = (edge_mode == INCLUDE_EDGE)
+    report_every = progress.step(len_x) if progress is not None else len_x
+    next_report = report_every
+    start = 1
+    while start < len_x:
+        turn, offset = divmod(start, orig_len)
+        stop = turn * orig_len + min((offset // checkpoint + 1) * checkpoint, orig_len)
+        for jj in range(start, stop):
+            if jj == next_report:
+                progress.report(jj / len_x)
+                next_report += report_every
+            val = xx[jj % orig_len]
+            # maxima
+            if val > min_val + tolerance:
+                left_valley_found = True
+            if val > max_val and left_valley_found:
+                max_val = val
+                max_pos = jj
+            if left_valley_found:
+                last_max_pos = max_pos
+            if val < max_val - tolerance and left_valley_found:
+                max_positions.append(max_pos)
+                left_valley_found = False
+                min_val = val
+                max_val = val
+            if val < min_val:
+                min_val = val
+                if not left_valley_found:
+                    max_val = val
+            # minima
+            if val < hi_val - tolerance:
+                left_peak_found = True
+            if val < lo_val and left_peak_found:
+                lo_val = val
+                min_pos = jj
+            if left_peak_found:
+                last_min_pos = min_pos
+            if val > lo_val + tolerance and left_peak_found:
+                min_positions.append(min_pos)
+                left_peak_found = False
+                hi_val = val
+                lo_val = val
+            if val > hi_val:
+                hi_val = val
+                if not left_peak_found:
+                    lo_val = val
+        start = stop
+        if circular:
+            values = [max_val, min_val, hi_val, lo_val]
+            flags = [max_pos, min_pos, last_max_pos, last_min_pos, left_valley_found, left_peak_found]
+            max_counts[stop] = len(max_positions)
+            min_counts[stop] = len(min_positions)
+            snapshots[stop] = (values, flags)
+            previous = snapshots.get(stop - orig_len)
+            if previous is not None and same_ring_state(values, flags, *previous, orig_len):
+                max_positions = repeat_turns(max_positions, max_counts, stop, orig_len, len_x, orig_len)
+                min_positions = repeat_turns(min_positions, min_counts, stop, orig_len, len_x, orig_len)
+                break
+    if edge_mode == INCLUDE_EDGE:
+        if max_positions and max_positions[-1] != last_max_pos:
+            max_positions.append(last_max_pos)
+        elif not max_positions and max_val - min_val >= tolerance:
+            max_positions.append(last_max_pos)
+        if min_positions and min_positions[-1] != last_min_pos:
+            min_positions.append(last_min_pos)
+        elif not min_positions and hi_val - lo_val >= tolerance:
+            min_positions.append(last_min_pos)
+    if progress is not None:
+        progress.report(1)
+
+    plateau_ends = find_plateau_ends(xx)
+    maxima = rank_positions(xx, max_positions, plateau_ends, edge_mode, False)
+    minima = rank_positions(xx, min_positions, plateau_ends, edge_mode, True)
+    return maxima, minima
+
+
+def find_plateau_ends(xx):
+    # last index of the run of equal samples each index belongs to
+    plateau_ends = np.flatnonzero(~(xx[:-1] == xx[1:]))
+    return np.append(plateau_ends, len(xx) - 1)
+
+
+def rank_positions(xx, positions, plateau_ends, edge_mode, minima):
+    # positions may point into any of the three turns of a circular scan
+    CIRCULAR = 2
+    orig_len = len(xx)
+    positions = np.asarray(positions, dtype=int)
+    turn, offset = np.divmod(positions, orig_len)
+    ends = turn * orig_len + plateau_ends[np.searchsorted(plateau_ends, offset)]
+    if edge_mode == CIRCULAR and xx[-1] == xx[0]:
+        # plateaus reaching the end of a turn continue into the next one
+        wrap = (ends % orig_len == orig_len - 1) & (turn < 2)
+        if plateau_ends[0] == orig_len - 1:
+            ends[wrap] = 3 * orig_len - 1
+        else:
+            ends[wrap] = (turn[wrap] + 1) * orig_len + plateau_ends[0]
+    # move each peak to the middle of its plateau
+    positions = positions + (ends - positions) // 2
+    values = xx[positions % orig_len].astype(np.float64)
+    if minima:
+        values = -values
+
+    # use descending order
+    return_arr = positions[np.argsort(values)][::-1].copy()
+    if edge_mode == CIRCULAR:
+        # pick peaks from the middle turn
+        return_arr = return_arr - orig_len
+        return_arr = return_arr[(return_arr >= 0) & (return_arr < orig_len)]
+    return return_arr
+
+
+## VECTORIZED ENGINE ##
+
+def turning_points(xx):
+    # Samples inside a monotonic run, repeated samples and NaNs never change the
+    # state of the find_extrema scan, so only the first sample of every local
+    # extremum (plus both ends of the signal) has to be visited.
+    idx = np.flatnonzero(~np.isnan(xx)) if xx.dtype.kind == 'f' else np.arange(len(xx))
+    vals = xx[idx]
+    if len(vals) > 1:
+        changed = np.empty(len(vals), dtype=bool)
+        changed[0] = True
+        changed[1:] = vals[1:] != vals[:-1]
+        idx = idx[changed]
+        vals = vals[changed]
+    if len(vals) > 2:
+        rising = vals[1:] > vals[:-1]
+        keep = np.ones(len(vals), dtype=bool)
+        keep[1:-1] = rising[1:] != rising[:-1]
+        idx = idx[keep]
+        vals = vals[keep]
+    return idx, vals
+
+
+def scan_state(val, pos, include_edge):
+    # State of the find_extrema machines after their first sample, as
+    # values = [max_val, min_val, hi_val, lo_val] and flags = [max_pos, min_pos,
+    # last_max_pos, last_min_pos, left_valley_found, left_peak_found].
+    # find_extrema always runs at least one iteration, which sets last_max_pos
+    # and last_min_pos when include_edge is on, even if every later sample is
+    # skipped by the turning point scan
+    last_pos = pos if include_edge else -1
+    return [val] * 4, [pos, pos, last_pos, last_pos, int(include_edge), int(include_edge)]
+
+
+def _scan_turning_points(idx, vals, tolerance, values, flags):
+    # Same state machines as find_extrema, run over the output of turning_points
+    # from the state in values/flags, which is updated in place
+    max_positions = np.zeros(len(idx), dtype=np.int64)
+    min_positions = np.zeros(len(idx), dtype=np.int64)
+    max_val = values[0]
+    min_val = values[1]
+    hi_val = values[2]
+    lo_val = values[3]
+    max_pos = flags[0]
+    min_pos = flags[1]
+    last_max_pos = flags[2]
+    last_min_pos = flags[3]
+    left_valley_found = flags[4] != 0
+    left_peak_found = flags[5] != 0
+    max_count = 0
+    min_count = 0
+    for jj in range(len(idx)):
+        val = vals[jj]
+        # maxima
+        if val > min_val + tolerance:
+            left_valley_found = True
+        if val > max_val and left_valley_found:
+            max_val = val
+            max_pos = idx[jj]
+        if left_valley_found:
+            last_max_pos = max_pos
+        if val < max_val - tolerance and left_valley_found:
+            max_positions[max_count] = max_pos
+            max_count += 1
+            left_valley_found = False
+            min_val = val
+            max_val = val
+        if val < min_val:
+            min_val = val
+            if not left_valley_found:
+                max_val = val
+        # minima
+        if val < hi_val - tolerance:
+            left_peak_found = True
+        if val < lo_val and left_peak_found:
+            lo_val = val
+            min_pos = idx[jj]
+        if left_peak_found:
+            last_min_pos = min_pos
+        if val > lo_val + tolerance and left_peak_found:
+            min_positions[min_count] = min_pos
+            min_count += 1
+            left_peak_found = False
+            hi_val = val
+            lo_val = val
+        if val > hi_val:
+            hi_val = val
+            if not left_peak_found:
+                lo_val = val
+    values[0] = max_val
+    values[1] = min_val
+    values[2] = hi_val
+    values[3] = lo_val
+    flags[0] = max_pos
+    flags[1] = min_pos
+    flags[2] = last_max_pos
+    flags[3] = last_min_pos
+    flags[4] = 1 if left_valley_found else 0
+    flags[5] = 1 if left_peak_found else 0
+    return max_positions[:max_count], min_positions[:min_count]
+
+
+_scan_kernel = compile_kernel(_scan_turning_points)
+
+
+def scan_chunk(idx, vals, tolerance, values, flags):
+    # runs the machines over the turning points idx/vals from the state lists
+    # values/flags (see scan_state), returning the peaks confirmed meanwhile
+    state_values = np.array(values, dtype=np.float64)
+    state_flags = np.array(flags, dtype=np.int64)
+    max_positions, min_positions = run_kernel(_scan_kernel, _scan_turning_points,
+                                              (idx.astype(np.int64), vals.astype(np.float64), float(tolerance)),
+                                              (state_values, state_flags))
+    values[:] = state_values.tolist()
+    flags[:] = state_flags.tolist()
+    return max_positions, min_positions
+
+
+def edge_peaks(values, flags, last_max_found, last_min_found, tolerance):
+    # the peaks find_extrema adds at the end of the signal when include_edge is
+    # on; last_*_found is the last peak found by the scan, or None
+    max_val, min_val, hi_val, lo_val = values
+    max_positions = []
+    min_positions = []
+    if last_max_found is not None and last_max_found != flags[2]:
+        max_positions.append(flags[2])
+    elif last_max_found is None and max_val - min_val >= tolerance:
+        max_positions.append(flags[2])
+    if last_min_found is not None and last_min_found != flags[3]:
+        min_positions.append(flags[3])
+    elif last_min_found is None and hi_val - lo_val >= tolerance:
+        min_positions.append(flags[3])
+    return max_positions, min_positions
+
+
+def scan_extrema(idx, vals, tolerance, include_edge):
+    values, flags = scan_state(vals[0].item(), int(idx[0]), include_edge)
+    max_positions, min_positions = scan_chunk(idx[1:], vals[1:], tolerance, values, flags)
+    if include_edge:
+        last_max_found = max_positions[-1] if len(max_positions) else None
+        last_min_found = min_positions[-1] if len(min_positions) else None
+        max_edge, min_edge = edge_peaks(values, flags, last_max_found, last_min_found, tolerance)
+        max_positions = np.append(max_positions, np.asarray(max_edge, dtype=np.int64))
+        min_positions = np.append(min_positions, np.asarray(min_edge, dtype=np.int64))
+    return max_positions, min_positions
+
+
+def scan_ring(idx, vals, tolerance, orig_len):
+    # The circular scan of find_extrema over the turning points: every turn of
+    # the ring visits the same turning points, orig_len samples later. The
+    # turns are scanned in RING_CHECKPOINT slices, and the scan stops at the
+    # first checkpoint where it repeats the previous turn (see repeat_turns),
+    # usually a few peaks into the second turn. Times count turning points.
+    period = len(idx)
+    end = 3 * period
+    values, flags = scan_state(vals[0].item(), int(idx[0]), False)
+    max_found = []
+    min_found = []
+    max_counts = {}
+    min_counts = {}
+    snapshots = {}
+    n_maxima = n_minima = 0
+    start = 1
+    while start < end:
+        turn, offset = divmod(start, period)
+        stop = min((offset // RING_CHECKPOINT + 1) * RING_CHECKPOINT, period)
+        max_positions, min_positions = scan_chunk(idx[offset:stop] + turn * orig_len, vals[offset:stop],
+                                                  tolerance, values, flags)
+        max_found.append(max_positions)
+        min_found.append(min_positions)
+        n_maxima += len(max_positions)
+        n_minima += len(min_positions)
+        start = turn * period + stop
+        max_counts[start] = n_maxima
+        min_counts[start] = n_minima
+        snapshots[start] = (list(values), list(flags))
+        previous = snapshots.get(start - period)
+        if previous is not None and same_ring_state(values, flags, *previous, orig_len):
+            return (repeat_turns(np.concatenate(max_found), max_counts, start, period, end, orig_len),
+                    repeat_turns(np.concatenate(min_found), min_counts, start, period, end, orig_len))
+    return np.concatenate(max_found), np.concatenate(min_found)
+
+
+def find_extrema_vectorized(xx, tolerance, edge_mode):
+    xx = np.asarray(xx)
+    if len(xx) < 2:
+        return [], []
+    idx, vals = turning_points(xx)
+    return extrema_from_turning_points(xx, idx, vals, find_plateau_ends(xx), tolerance, edge_mode)
+
+
+def extrema_from_turning_points(xx, idx, vals, plateau_ends, tolerance, edge_mode):
+    # find_extrema_vectorized once turning_points and find_plateau_ends are known
+    INCLUDE_EDGE = 0
+    CIRCULAR = 2
+    orig_len = len(xx)
+    if tolerance < 0:
+        tolerance = 0
+    if xx.dtype.kind == 'f' and np.isnan(xx[0]):
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+    if edge_mode == CIRCULAR:
+        max_positions, min_positions = scan_ring(idx, vals, tolerance, orig_len)
+    else:
+        max_positions, min_positions = scan_extrema(idx, vals, tolerance, edge_mode == INCLUDE_EDGE)
+
+    maxima = rank_positions(xx, max_positions, plateau_ends, edge_mode, False)
+    minima = rank_positions(xx, min_positions, plateau_ends, edge_mode, True)
+    return maxima, minima
+
+
+
+class PeakIndex():
+    """The tolerance-free part of the detection on one signal, kept to answer
+    PeakFinder again when only its parameters change.
+
+    The turning points (the candidate extrema, see turning_points) and the
+    plateaus of the signal are found once. A new tolerance or edge mode then
+    only scans the turning points again, and the ranked peaks of the last
+    ``max_results`` tolerances are kept, so new height or distance thresholds
+    only filter them. Build a new index when the signal changes.
+    """
+    def __init__(self, yvalues, max_results=8):
+        self.yvalues = np.asarray(yvalues)
+        self.max_results = max_results
+        self._extrema = OrderedDict()
+        if len(self.yvalues) >= 2:
+            self.idx, self.vals = turning_points(self.yvalues)
+            self.plateau_ends = find_plateau_ends(self.yvalues)
+
+    def extrema(self, tolerance, edge_mode):
+        # ranked maxima and minima before the height and distance filters
+        key = (max(tolerance, 0), edge_mode)
+        if key in self._extrema:
+            self._extrema.move_to_end(key)
+            return self._extrema[key]
+        if len(self.yvalues) < 2:
+            extrema = ([], [])
+        else:
+            extrema = extrema_from_turning_points(self.yvalues, self.idx, self.vals, self.plateau_ends,
+                                                  tolerance, edge_mode)
+            # the cached arrays are shared by the results of every call
+            for positions in extrema:
+                positions.flags.writeable = False
+        self._extrema[key] = extrema
+        while len(self._extrema) > self.max_results:
+            self._extrema.popitem(last=False)
+        return extrema
+
+    def find(self, tolerance, minPeakDistance=0, minMaximaValue=np.nan, maxMaximaValue=np.nan,
+             excludeOnEdges=False, edge_mode=None):
+        maxima, minima = self.extrema(tolerance, resolve_edge_mode(excludeOnEdges, edge_mode))
+        # the x values are the sample numbers, which filter_peaks uses for None
+        return filter_peaks(maxima, minima, self.yvalues, None, minPeakDistance, minMaximaValue, maxMaximaValue)
+
+    def shapes(self, tolerance, edge_mode):
+        # peak_shapes of every maximum and minimum found with tolerance, before the filters
+        maxima, minima = self.extrema(tolerance, edge_mode)
+        if len(self.yvalues) < 2:
+            return peak_shapes(self.yvalues, [], [], maxima, False), peak_shapes(self.yvalues, [], [], minima, True)
+        return (peak_shapes(self.yvalues, self.idx, self.vals, maxima, False),
+                peak_shapes(self.yvalues, self.idx, self.vals, minima, True))
+
+    def prominences(self):
+        # sorted prominences of the candidate maxima, see maxima_prominences
+        if not hasattr(self, "_prominences"):
+            if len(self.yvalues) < 2:
+                self._prominences = np.empty(0)
+            else:
+                self._prominences = np.sort(maxima_prominences(self.vals))
+                self._prominences.flags.writeable = False
+        return self._prominences
+
+
+## TOLERANCE ESTIMATION ##
+
+TOLERANCE_METHODS = ["std", "mad", "prominence"]
+
+
+def _base_levels(vals, over_equal, bases, stack_vals, stack_mins):
+    # bases[i] is the lowest value between vals[i] and the closest higher value
+    # on its left (equal values count as higher unless over_equal), inf if there
+    # is none. The stack holds the values still waiting for a higher one, with
+    # the lowest value between each of them and the one below it
+    top = 0
+    for i in range(len(vals)):
+        val = vals[i]
+        low = np.inf
+        while top > 0 and (stack_vals[top - 1] < val or (over_equal and stack_vals[top - 1] == val)):
+            top -= 1
+            low = min(low, stack_vals[top], stack_mins[top])
+        bases[i] = low
+        stack_vals[top] = val
+        stack_mins[top] = low
+        top += 1
+
+
+_base_kernel = compile_kernel(_base_levels)
+
+
+def base_levels(vals, over_equal):
+    vals = np.ascontiguousarray(vals, dtype=np.float64)
+    bases = np.empty(len(vals))
+    run_kernel(_base_kernel, _base_levels, (vals, over_equal), (bases, np.empty(len(vals)), np.empty(len(vals))))
+    return bases
+
+
+def maxima_prominences(vals):
+    # Prominence of every maximum of the turning points vals: its height over
+    # the higher of the lowest points separating it from a higher peak (or the
+    # edge) on either side. The scan finds a maximum for every tolerance below
+    # its prominence, so sorting them gives the whole peak count vs tolerance
+    # curve. Of equal peaks, only the first one can be higher than the valley
+    # between them, as in the scan; peaks on the edges are left out. The
+    # prominence of peak_shapes follows the usual definition instead, where
+    # equal peaks keep the full prominence.
+    vals = np.asarray(vals, dtype=np.float64)
+    if len(vals) < 3:
+        return np.empty(0)
+    left = base_levels(vals, False)
+    right = base_levels(vals[::-1], True)[::-1]
+    is_maximum = np.zeros(len(vals), dtype=bool)
+    is_maximum[1:-1] = (vals[1:-1] > vals[:-2]) & (vals[1:-1] > vals[2:])
+    return (vals - np.maximum(left, right))[is_maximum]
+
+
+def noise_level(yvalues):
+    # Robust standard deviation of the noise: the median absolute deviation of
+    # the sample to sample differences, which is little affected by the peaks,
+    # scaled to a normal standard deviation of the samples
+    yvalues = np.asarray(yvalues, dtype=np.float64)
+    diff = np.diff(yvalues[~np.isnan(yvalues)])
+    if len(diff) == 0:
+        return 0.
+    return float(1.4826 * np.median(np.abs(diff - np.median(diff))) / np.sqrt(2))
+
+
+def tolerance_curve(yvalues, tolerances=None, index=None):
+    """Number of maxima found with each tolerance, from a single pass.
+
+    Returns ``(tolerances, counts)``. Without ``tolerances`` the curve is given
+    at 0 and at every tolerance where the count changes. The counts are those
+    of PeakFinder in the "exclude" edge mode, before the distance and height
+    filters. ``index`` is an optional PeakIndex of yvalues whose turning points
+    are reused.
+    """
+    if index is None:
+        index = PeakIndex(yvalues, max_results=0)
+    prominences = index.prominences()
+    if tolerances is None:
+        tolerances = np.concatenate([[0.], np.unique(prominences)])
+    tolerances = np.asarray(tolerances, dtype=np.float64)
+    # the scan only confirms peaks more prominent than the tolerance
+    counts = len(prominences) - np.searchsorted(prominences, tolerances, side="right")
+    return tolerances, counts
+
+
+def estimate_tolerance(yvalues, method="prominence", factor=3., index=None):
+    """Proposed tolerance for PeakFinder on yvalues.
+
+    "std" is the standard deviation of the signal, the former default. "mad"
+    is ``factor`` times the noise_level. "prominence" is the middle of the
+    widest range of tolerances, on a log scale and above the noise level, over
+    which the number of peaks does not change, i.e. the largest gap between
+    the sorted prominences of the peaks, keeping at least two peaks.
+    """
+    if method not in TOLERANCE_METHODS:
+        raise ValueError(f"Unknown tolerance method {method!r}, expected one of {TOLERANCE_METHODS}")
+    if method == "std":
+        return float(np.nanstd(yvalues))
+    noise = noise_level(yvalues)
+    if method == "mad":
+        return factor * noise
+
+    if index is None:
+        index = PeakIndex(yvalues, max_results=0)
+    prominences = index.prominences()
+    prominences = prominences[prominences >= max(noise, np.finfo(np.float64).tiny)]
+    if len(prominences) < 3:
+        return factor * noise
+    gaps = np.diff(np.log(prominences[:-1]))
+    cut = np.argmax(gaps)
+    return float(np.sqrt(prominences[cut] * prominences[cut + 1]))
+
+
+## PEAK SHAPES ##
+
+def _lowest_between(idx, vals, bounds, positions, values):
+    # positions[j] and values[j]: the first lowest turning point strictly
+    # between bounds[j] and bounds[j + 1], -1 and inf if there is none. bounds
+    # are sorted, so the turning points are walked once
+    t = 0
+    for j in range(len(bounds) - 1):
+        while t < len(idx) and idx[t] <= bounds[j]:
+            t += 1
+        best = -1
+        low = np.inf
+        while t < len(idx) and idx[t] < bounds[j + 1]:
+            if vals[t] < low:
+                low = vals[t]
+                best = idx[t]
+            t += 1
+        positions[j] = best
+        values[j] = low
+
+
+def _half_widths(xx, sign, peaks, left_bases, right_bases, heights, widths):
+    # width of every peak at heights (of sign * xx), from the first sample
+    # below it on either side, interpolated linearly. The walks stop at the
+    # bases, so each sample is visited for at most one peak
+    for i in range(len(peaks)):
+        height = heights[i]
+        left = float(left_bases[i])
+        j = peaks[i]
+        previous = j
+        while j > left_bases[i]:
+            j -= 1
+            val = sign * xx[j]
+            if val < height:
+                left = j + (height - val) / (sign * xx[previous] - val) * (previous - j)
+                break
+            if val == val:
+                # not NaN
+                previous = j
+        right = float(right_bases[i])
+        j = peaks[i]
+        previous = j
+        while j < right_bases[i]:
+            j += 1
+            val = sign * xx[j]
+            if val < height:
+                right = j - (height - val) / (sign * xx[previous] - val) * (j - previous)
                 break
-        if not trim:
-            temp[newsize] = pos1
-            newsize += 1
-    newpositions = [temp[i] for i in range(newsize)]
-    return newpositions
\ No newline at end of file
+            if val == val:
+                previous = j
+        widths[i] = right - left
+
+
+_lowest_kernel = compile_kernel(_lowest_between)
+_width_kernel = compile_kernel(_half_widths)
+
+
+def peak_shapes(xx, idx, vals, positions, minima):
+    """Prominence, bases and width of the peaks of one kind found by the scan.
+
+    The prominence is the height of a peak over the higher of the lowest
+    samples (highest for minima) separating it from a higher peak, or from the
+    end of the signal, on either side, as in scipy.signal.peak_prominences; a
+    peak on an edge only has its other side. The bases are the lowest samples
+    between a peak and the neighbouring peaks of ``positions`` (or the ends of
+    the signal), the base height is the height of the peak over the higher
+    base, and the width is measured at half the base height, interpolated
+    between samples. ``idx`` and ``vals`` are the turning points of xx, where
+    the bases are looked for, so the signal itself is only read around the
+    peaks. Returns a dict of arrays sorted by position.
+    """
+    xx = np.asarray(xx)
+    idx = np.asarray(idx, dtype=np.int64)
+    sign = -1. if minima else 1.
+    signed_vals = sign * np.asarray(vals, dtype=np.float64)
+    peaks = np.sort(np.asarray(positions, dtype=np.int64))
+    heights = sign * xx[peaks].astype(np.float64)
+
+    # every peak starts at a turning point (the first sample of its plateau),
+    # which is higher than the turning points next to it
+    rows = np.searchsorted(idx, peaks, side="right") - 1
+    left_levels = base_levels(signed_vals, True)[rows]
+    right_levels = base_levels(signed_vals[::-1], True)[::-1][rows]
+    left_levels, right_levels = (np.where(np.isinf(left_levels), right_levels, left_levels),
+                                 np.where(np.isinf(right_levels), left_levels, right_levels))
+    prominence = heights - np.maximum(left_levels, right_levels)
+    # a lone peak without any base
+    prominence[np.isinf(prominence)] = 0.
+
+    bounds = np.concatenate([[-1], peaks, [len(xx)]]).astype(np.int64)
+    base_positions = np.empty(len(peaks) + 1, dtype=np.int64)
+    base_values = np.empty(len(peaks) + 1)
+    run_kernel(_lowest_kernel, _lowest_between, (idx, signed_vals, bounds), (base_positions, base_values))
+
+    left_base = np.where(base_positions[:-1] < 0, peaks, base_positions[:-1])
+    right_base = np.where(base_positions[1:] < 0, peaks, base_positions[1:])
+    left_values = np.where(np.isinf(base_values[:-1]), base_values[1:], base_values[:-1])
+    right_values = np.where(np.isinf(base_values[1:]), base_values[:-1], base_values[1:])
+    base_height = heights - np.maximum(left_values, right_values)
+    # a lone peak without any base
+    base_height[np.isinf(base_height)] = 0.
+
+    widths = np.empty(len(peaks))
+    run_kernel(_width_kernel, _half_widths,
+               (np.ascontiguousarray(xx, dtype=np.float64), sign, peaks, left_base, right_base,
+                heights - base_height / 2),
+               (widths,))
+    return {"positions": peaks,
+            "prominence": prominence,
+            "base_height": base_height,
+            "left_base": left_base,
+            "right_base": right_base,
+            "width": widths}
+
+
+## STREAMING ##
+
+# run end of a peak on the plateau still running at the end of the last chunk
+OPEN_RUN = -1
+
+
+class StreamingPeakFinder():
+    """find_extrema over a signal that arrives in chunks.
+
+    update() runs the state machines of the vectorized engine over the next
+    chunk, carrying their state over from the previous one, and returns the
+    maxima and minima confirmed so far as (position, value) pairs in the order
+    they are found. Peaks are moved to the middle of their plateau like
+    rank_positions does, so a peak on a plateau that is still running is only
+    returned once the plateau ends; finish() returns the remaining ones.
+    Memory is bounded by the chunk size. Circular edges need the whole signal
+    and are not supported.
+    """
+
+    def __init__(self, tolerance, excludeOnEdges=False, edge_mode=None):
+        edge_mode = resolve_edge_mode(excludeOnEdges, edge_mode)
+        if edge_mode == EDGE_MODES["circular"]:
+            raise ValueError("Circular edges need the whole signal, use PeakFinder instead")
+        self.include_edge = edge_mode == EDGE_MODES["include"]
+        self.tolerance = max(tolerance, 0)
+        self.n_samples = 0
+        self.values = None
+        self.flags = None
+        self.last_value = None
+        # last sample of the previous chunk, whose plateau may go on
+        self.open_value = np.nan
+        # [run end, value] of the positions kept in flags
+        self.candidates = {}
+        # peaks found on the open plateau, as [position, run end, value]
+        self.pending = {False: [], True: []}
+        self.last_found = {False: None, True: None}
+
+    def update(self, chunk):
+        chunk = np.asarray(chunk)
+        offset = self.n_samples
+        size = len(chunk)
+        if size == 0:
+            return [], []
+        self.n_samples += size
+
+        plateau_ends = find_plateau_ends(chunk)
+        if not chunk[0] == self.open_value:
+            self.close_run(offset - 1)
+        elif plateau_ends[0] < size - 1:
+            self.close_run(offset + plateau_ends[0])
+        self.open_value = chunk[-1]
+        # run end of every sample that starts a run in this chunk
+        run_ends = np.where(plateau_ends == size - 1, OPEN_RUN, plateau_ends + offset)
+
+        if self.values is None:
+            if chunk.dtype.kind == 'f' and np.isnan(chunk[0]):
+                # like find_extrema, a signal starting with NaN has no peaks
+                self.values = []
+                return [], []
+            self.last_value = chunk[0].item()
+            self.values, self.flags = scan_state(self.last_value, offset, self.include_edge)
+            self.candidates[offset] = [int(run_ends[0]), self.last_value]
+        if not self.values:
+            return [], []
+
+        idx, vals = turning_points(chunk)
+        # the first sample of the signal only sets the state, and samples
+        # repeating the last scanned value never change it
+        if len(vals) > 0 and ((offset == 0 and idx[0] == 0) or vals[0] == self.last_value):
+            idx = idx[1:]
+            vals = vals[1:]
+        if len(vals) == 0:
+            return [], []
+        self.last_value = vals[-1].item()
+        ends = run_ends[np.searchsorted(plateau_ends, idx)]
+        idx = idx + offset
+
+        max_positions, min_positions = scan_chunk(idx, vals, self.tolerance, self.values, self.flags)
+        maxima = self.confirm(max_positions, idx, ends, vals, False)
+        minima = self.confirm(min_positions, idx, ends, vals, True)
+
+        candidates = {}
+        for pos in self.flags[:4]:
+            if pos in self.candidates:
+                candidates[pos] = self.candidates[pos]
+            elif pos >= offset:
+                row = np.searchsorted(idx, pos)
+                candidates[pos] = [int(ends[row]), vals[row].item()]
+        self.candidates = candidates
+        return maxima, minima
+
+    def close_run(self, end):
+        for candidate in self.candidates.values():
+            if candidate[0] == OPEN_RUN:
+                candidate[0] = end
+        for peaks in self.pending.values():
+            for peak in peaks:
+                if peak[1] == OPEN_RUN:
+                    peak[1] = end
+
+    def confirm(self, positions, idx, ends, vals, minima):
+        if len(positions) == 0:
+            return self.release(minima)
+        self.last_found[minima] = int(positions[-1])
+        rows = np.minimum(np.searchsorted(idx, positions), len(idx) - 1)
+        peaks = [list(peak) for peak in zip(positions.tolist(), ends[rows].tolist(), vals[rows].tolist())]
+        # peaks found before this chunk were still candidates at its start
+        for peak in peaks[:np.count_nonzero(positions < idx[0])]:
+            peak[1:] = self.candidates[peak[0]]
+        self.pending[minima] += peaks
+        return self.release(minima)
+
+    def release(self, minima):
+        # only the last peak can be on the open plateau
+        pending = self.pending[minima]
+        if pending and pending[-1][1] == OPEN_RUN:
+            done, self.pending[minima] = pending[:-1], pending[-1:]
+        else:
+            done, self.pending[minima] = pending, []
+        # move each peak to the middle of its plateau
+        return [(pos + (end - pos) // 2, value) for pos, end, value in done]
+
+    def finish(self):
+        # the last plateau ends with the signal
+        self.close_run(self.n_samples - 1)
+        if self.n_samples < 2 or not self.values:
+            return [], []
+        if self.include_edge:
+            max_edge, min_edge = edge_peaks(self.values, self.flags, self.last_found[False],
+                                            self.last_found[True], self.tolerance)
+            self.pending[False] += [[pos] + self.candidates[pos] for pos in max_edge]
+            self.pending[True] += [[pos] + self.candidates[pos] for pos in min_edge]
+        return self.release(False), self.release(True)
+
+
+def peak_arrays(peaks):
+    # positions and values of (position, value) peaks
+    positions = np.fromiter((pos for pos, _ in peaks), dtype=np.int64, count=len(peaks))
+    values = np.fromiter((value for _, value in peaks), dtype=np.float64, count=len(peaks))
+    return positions, values
+
+
+def rank_peaks(arrays, minima):
+    # positions and values of the peak_arrays in rank_positions order
+    positions = np.concatenate([np.empty(0, dtype=np.int64)] + [positions for positions, _ in arrays])
+    values = np.concatenate([np.empty(0)] + [values for _, values in arrays])
+    order = np.argsort(-values if minima else values)[::-1]
+    return positions[order], values[order]
+
+
+def filter_ranked_peaks(positions, values, threshold, min_peak_distance, minima):
+    # detect_peaks filtering, from the peak values instead of the whole signal
+    if not np.isnan(threshold):
+        keep = trim_peak_height(np.arange(len(positions)), values, threshold, minima)
+        positions = positions[keep]
+    if min_peak_distance > 0:
+        positions = positions[trim_peak_distance(np.arange(len(positions)), positions, min_peak_distance)]
+    return positions
@@ -0,0 +1,93 @@
+import json
+import os
+import time
+from collections import OrderedDict
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where the memory high-water mark is left out
+    resource = None
+
+
+# JSON lines file the stage records are appended to, inherited by worker processes
+TRACE_ENV = "PEAKFINDER_TRACE"
+
+_context = {}
+
+
+class Stage():
+    """Times one stage of the pipeline and appends it to the trace file.
+
+    The record is a dict the stage can add counts to (samples, peaks, ...);
+    wall and CPU time, the memory high-water mark of the process and the
+    current context (file, sheet) are added when the stage ends.
+    """
+    def __init__(self, trace_path, name, fields):
+        self.trace_path = trace_path
+        self.record = {"stage": name, **_context, **fields}
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self.record
+
+    def __exit__(self, exc_type, exc, tb):
+        record = self.record
+        record["wall"] = round(time.perf_counter() - self.wall, 6)
+        record["cpu"] = round(time.process_time() - self.cpu, 6)
+        if resource is not None:
+            # kilobytes on Linux
+            record["max_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        record["pid"] = os.getpid()
+        if exc_type is not None:
+            record["error"] = repr(exc)
+        # a single short append per line, so concurrent processes do not mix their lines
+        with open(self.trace_path, "a") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+        return False
+
+
+class _NoStage():
+    # what stage() returns when tracing is off: nothing is measured or written
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name, **fields):
+    trace_path = os.environ.get(TRACE_ENV)
+    if not trace_path:
+        return _NO_STAGE
+    return Stage(trace_path, name, fields)
+
+
+def enable_trace(trace_path):
+    # set before starting worker processes, so they trace into the same file
+    os.environ[TRACE_ENV] = os.path.abspath(trace_path)
+
+
+def set_context(**fields):
+    # fields added to every following record of this process, e.g. file and sheet
+    _context.clear()
+    _context.update({name: value for name, value in fields.items() if value is not None})
+
+
+def summarize(trace_path):
+    # totals per file and stage: {file: {stage: {"count", "wall", "cpu", "max_rss_mb"}}}
+    summary = OrderedDict()
+    with open(trace_path) as f:
+        for line in f:
+            record = json.loads(line)
+            stages = summary.setdefault(record.get("file", ""), OrderedDict())
+            total = stages.setdefault(record["stage"], {"count": 0, "wall": 0., "cpu": 0., "max_rss_mb": 0.})
+            total["count"] += 1
+            total["wall"] += record["wall"]
+            total["cpu"] += record["cpu"]
+            total["max_rss_mb"] = max(total["max_rss_mb"], record.get("max_rss_mb", 0.))
+    return summary
@@ -3,8 +3,14 @@ import logging
 import numpy as np
 import openpyxl
 import os
+import json
+from collections import OrderedDict
+from openpyxl.packaging.custom import StringProperty
 
 from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from Libs.instrument import stage
 
 
 logger = logging.getLogger(__name__)
@@ -14,96 +20,196 @@ logger.setLevel(logging.DEBUG)
 ## IMPORT DF FROM EXCEL ##
 
 def init_core_folders(project_path):
-    core_folders = ["Log", "Output"]
+    core_folders = ["Log", "Output", "Cache"]
     for folder in core_folders:
         if not os.path.exists(os.path.join(project_path, folder)):
             os.makedirs(os.path.join(project_path, folder))
     
 
+class WorkbookSession():
+    """An Excel workbook opened once, in read-only mode.
+
+    Serves the sheet names and the cleaned DataFrame of each sheet (see
+    read_clean_excel). The ``max_sheets`` most recently used DataFrames are
+    kept, so switching back and forth between sheets does not parse them again.
+    """
+    def __init__(self, excel_path, max_sheets=8):
+        self.excel_path = excel_path
+        self.max_sheets = max_sheets
+        # pandas opens the workbook with openpyxl in read-only mode
+        self.excel_file = pd.ExcelFile(excel_path, engine="openpyxl")
+        self.sheet_names = self.excel_file.sheet_names
+        self._sheets = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._sheets.clear()
+        self.excel_file.close()
+
+    def default_sheet(self):
+        # first sheet that is not a summary
+        for sheet_name in self.sheet_names:
+            if "summary" not in sheet_name.lower():
+                return sheet_name
+        raise ValueError(f"No data sheet found in {self.excel_path}")
+
+    def read(self, sheet_name=None):
+        if sheet_name is None:
+            sheet_name = self.default_sheet()
+        if sheet_name in self._sheets:
+            self._sheets.move_to_end(sheet_name)
+            return self._sheets[sheet_name]
+
+        # only the first rows are needed to build the header, the body is then
+        # parsed on its own so numeric columns come out as float64 directly
+        with stage("load", sheet=sheet_name) as record:
+            header_rows = self.excel_file.parse(sheet_name=sheet_name, header=None, nrows=3)
+            columns, n_header_rows = clean_excel_header(header_rows)
+            df = self.excel_file.parse(sheet_name=sheet_name, header=None, skiprows=n_header_rows)
+            df = df.astype({column: np.float64 for column in df.select_dtypes("number").columns})
+
+            n_columns = max(len(columns), df.shape[1])
+            if df.shape[1] < n_columns:
+                df = df.reindex(columns=range(n_columns))
+            df.columns = list(columns) + [""] * (n_columns - len(columns))
+            record["samples"] = len(df)
+
+        if self.max_sheets > 0:
+            self._sheets[sheet_name] = df
+            while len(self._sheets) > self.max_sheets:
+                self._sheets.popitem(last=False)
+        return df
+
+    def columns(self, sheet_name=None):
+        return self.read(sheet_name).columns
+
+    def signal(self, column_name, sheet_name=None):
+        # numeric columns are already float64, so this does not copy them
+        return np.asarray(self.read(sheet_name)[column_name].values, dtype=np.float64)
+
+
 def read_clean_excel(excel_path, sheet_name=None):
+    with WorkbookSession(excel_path, max_sheets=0) as session:
+        return session.read(sheet_name)
 
-    if sheet_name is None:
-        # Get all sheet names of excel_path
-        wb = openpyxl.load_workbook(excel_path)
-        sheet_names = wb.sheetnames
 
-        i = 0
-        while True:
-            sheet_name = sheet_names[i]
-            if "summary" not in sheet_name.lower():
-                break
-            i += 1
+def clean_excel_header(header_rows):
+    # Returns the column names and the number of header rows found in the first
+    # rows of a sheet. An optional "scorer" row comes first, then the names are
+    # f"{content of row 1}_{content of row 2}", or just row 1 where row 2 is empty.
+    first_row = 0
+    if header_rows.iloc[0].astype(str).str.lower().str.contains("scorer").any():
+        first_row = 1
 
-    # load into df_whole, header = false
-    df_whole = pd.read_excel(excel_path, sheet_name=sheet_name, header=None)
+    names = header_rows.iloc[first_row].fillna("")
+    below = header_rows.iloc[first_row + 1]
+    columns = [cell if pd.isna(cell_below) else f"{cell}_{cell_below}"
+               for cell, cell_below in zip(names, below)]
 
-    # if first row contain a cell with "scorer", remove it
-    for cell in df_whole.iloc[0]:
-        if "scorer" in str(cell).lower():
-            df_whole = df_whole.drop(0)
-            break
+    return columns, first_row + 2
 
-    # reset index
-    df_whole = df_whole.reset_index(drop=True)
+## IMPORT SIGNAL FROM BINARY FILES ##
 
-    # Combine the content of row 1 and row 2 into one row, f"{content of row 1} {content of row 2}", if content of row 2 is NaN, then just use content of row 1
-    df_whole.iloc[0] = df_whole.iloc[0].fillna("")
+SIGNAL_EXTENSIONS = [".npy", ".bin", ".raw", ".dat"]
 
-    # iterate through cell in row 0
-    for i, cell in enumerate(df_whole.iloc[0]):
-        cell_below = df_whole.iloc[1][i]
-        if cell_below is np.nan:
-            df_whole.iloc[0][i] = cell
-        else:
-            df_whole.iloc[0][i] = f"{cell}_{cell_below}"
+def is_signal_file(path):
+    return os.path.splitext(str(path))[1].lower() in SIGNAL_EXTENSIONS
 
-    # drop row 1
-    df_whole = df_whole.drop(1)
 
-    # make row 0 as header
-    df_whole.columns = df_whole.iloc[0]
+def load_signal(path, column=None, dtype=np.float64, n_columns=1, offset=0):
+    # Read-only memory map of a .npy file, or of a raw binary file holding
+    # n_columns interleaved samples of dtype after offset header bytes (dtype,
+    # n_columns and offset come from the header of .npy files). Returns the
+    # given column, or all of them as a 2-D array, without copying any data.
+    if os.path.splitext(str(path))[1].lower() == ".npy":
+        data = np.load(path, mmap_mode="r")
+    else:
+        data = np.memmap(path, dtype=dtype, mode="r", offset=offset)
+        # an incomplete last row is ignored
+        data = data[:len(data) // n_columns * n_columns].reshape(-1, n_columns)
+    if data.ndim == 1:
+        data = data[:, np.newaxis]
+    if data.ndim != 2:
+        raise ValueError(f"Expected a 1-D or 2-D signal in {path}, got {data.ndim} dimensions")
+    if column is None:
+        return data
+    return data[:, int(column)]
 
-    # drop row 0
-    df_whole = df_whole.drop(0)
 
-    # reset index
-    df_whole = df_whole.reset_index(drop=True)
+class SignalSession():
+    """A .npy or raw binary signal file, opened like a WorkbookSession.
 
-    return df_whole
+    The file shows up as a single sheet whose columns are named "0", "1", ...
+    and signal() returns memory-mapped columns, so long recordings are read
+    from disk as the detection goes instead of being loaded first.
+    """
+    sheet_names = ["Signal"]
 
-## MAKE DF FOR SAVING ##
+    def __init__(self, path, dtype=np.float64, n_columns=1, offset=0):
+        self.excel_path = path
+        self.data = load_signal(path, dtype=dtype, n_columns=n_columns, offset=offset)
 
-def get_coordinates(values, positions):
-    size = len(positions)
-    cc = [values[positions[i]] for i in range(size)]
-    return cc
+    def __enter__(self):
+        return self
 
-def make_df(xvalues, yvalues, maxima, minima, threshold=10):
+    def __exit__(self, *exc_info):
+        self.close()
 
-    xMaxima = get_coordinates(xvalues, maxima)
-    yMaxima = get_coordinates(yvalues, maxima)
-    xMinima = get_coordinates(xvalues, minima)
-    yMinima = get_coordinates(yvalues, minima)
-    
-    maxima_result =  {xMaxima[i]: yMaxima[i] for i in range(len(xMaxima))}
-    maxima_result = dict(sorted(maxima_result.items()))
+    def close(self):
+        # the file is unmapped once the last column using it is released
+        self.data = None
+
+    def default_sheet(self):
+        return self.sheet_names[0]
+
+    def columns(self, sheet_name=None):
+        return [str(column) for column in range(self.data.shape[1])]
+
+    def signal(self, column_name, sheet_name=None):
+        return self.data[:, int(column_name)]
+
+
+def open_session(path, max_sheets=8, **signal_options):
+    # signal_options (dtype, n_columns, offset) only apply to raw binary files
+    if is_signal_file(path):
+        return SignalSession(path, **signal_options)
+    return WorkbookSession(path, max_sheets=max_sheets)
 
-    minima_result =  {xMinima[i]: yMinima[i] for i in range(len(xMinima))}
-    minima_result = dict(sorted(minima_result.items()))
+## MAKE DF FOR SAVING ##
+
+def get_coordinates(values, positions):
+    # values None stands for the sample numbers, as in trim_peak_distance
+    positions = np.asarray(positions, dtype=int)
+    return positions if values is None else np.asarray(values)[positions]
+
+def peak_columns(xvalues, yvalues, positions, min_threshold, max_threshold):
+    # sorted unique x of the peaks with their y, where a repeated x keeps its
+    # last y, and the row labels left after cropping x to [min, max);
+    # xvalues None stands for the sample numbers
+    x = get_coordinates(xvalues, positions)
+    y = get_coordinates(yvalues, positions)
+    x, last = np.unique(x[::-1], return_index=True)
+    y = y[::-1][last]
+    keep = (x >= min_threshold) & (x < max_threshold)
+    return x[keep].astype(int), y[keep].astype(float), np.flatnonzero(keep)
 
-    df_max = pd.DataFrame(list(maxima_result.items()),columns = ['X_maxima', 'Y_maxima'])
-    df_max['X_maxima'] = df_max['X_maxima'].astype(int)
-    df_max['Y_maxima'] = df_max['Y_maxima'].astype(float)
+def make_df(xvalues, yvalues, maxima, minima, threshold=10):
 
-    df_min = pd.DataFrame(list(minima_result.items()),columns = ['X_minima', 'Y_minima'])
-    df_min['X_minima'] = df_min['X_minima'].astype(int)
-    df_min['Y_minima'] = df_min['Y_minima'].astype(float)
+    with stage("make_df", maxima=len(maxima), minima=len(minima)) as record:
+        min_threshold = threshold
+        max_threshold = len(yvalues) - threshold - 1
+        # crop the rows with x < min_threshold and x >= max_threshold
+        xMaxima, yMaxima, index = peak_columns(xvalues, yvalues, maxima, min_threshold, max_threshold)
+        df_max = pd.DataFrame({'X_maxima': xMaxima, 'Y_maxima': yMaxima}, index=index)
 
-    min_threshold = threshold
-    max_threshold = len(yvalues) - threshold - 1
-    # crop the rows of df_max and df_min with x < min_threshold and x > max_threshold
-    df_max = df_max[(df_max['X_maxima'] >= min_threshold) & (df_max['X_maxima'] < max_threshold)]
-    df_min = df_min[(df_min['X_minima'] >= min_threshold) & (df_min['X_minima'] < max_threshold)]
+        xMinima, yMinima, index = peak_columns(xvalues, yvalues, minima, min_threshold, max_threshold)
+        df_min = pd.DataFrame({'X_minima': xMinima, 'Y_minima': yMinima}, index=index)
+        record["rows"] = len(df_max) + len(df_min)
 
     return df_max, df_min
 
@@ -170,36 +276,266 @@ def append_df_to_excel(filepath, df, sheet_name='Sheet1', startcol=None, startro
             df = df.iloc[1:, :]
 
     # write the dataframe to the existing sheet
-    df.to_excel(writer, sheet_name, startcol=startcol, startrow=startrow, **to_excel_kwargs)
+    df.to_excel(writer, sheet_name=sheet_name, startcol=startcol, startrow=startrow, **to_excel_kwargs)
 
     # close workbook
     writer.close()
 
+class ExcelPeakWriter():
+    """Collect the peak tables of several sheets and write them into a copy of
+    the workbook with a single load and a single save.
+
+    The sheets that already hold peaks are recorded in custom document
+    properties of the output workbook, so re-runs can skip them without
+    parsing any sheet.
+    """
+    METADATA_PREFIX = "PeakFinder:"
+
+    def __init__(self, excel_path, output_path):
+        self.excel_path = excel_path
+        self.output_path = output_path
+        self.tables = {}
+        self.processed = self.read_processed_sheets()
+
+    def read_processed_sheets(self):
+        if not os.path.exists(self.output_path):
+            return set()
+        wb = openpyxl.load_workbook(self.output_path, read_only=True)
+        try:
+            processed = {prop.name[len(self.METADATA_PREFIX):] for prop in wb.custom_doc_props.props
+                         if prop.name.startswith(self.METADATA_PREFIX)}
+            if not processed:
+                # outputs written before the metadata existed: look at the header rows only
+                for ws in wb.worksheets:
+                    for row in ws.iter_rows(max_row=3, values_only=True):
+                        if any(("y_maxima" in str(cell).lower()) or ("minima" in str(cell).lower()) for cell in row):
+                            processed.add(ws.title)
+                            break
+        finally:
+            wb.close()
+        return processed
+
+    def add(self, sheet_name, df_maxima, df_minima, metadata=None):
+        # metadata is accepted like TablePeakWriter.add, but document properties
+        # are limited to 255 characters, so only the table layout is recorded
+        if sheet_name in self.processed:
+            logger.info(f"Found maxima and minima columns in {sheet_name}, skip saving")
+            return False
+        self.tables[sheet_name] = (df_maxima, df_minima)
+        return True
+
+    def write(self):
+        if not self.tables:
+            return
+        with stage("excel_write", file=os.path.basename(self.excel_path), sheet=None, sheets=len(self.tables)):
+            # the output is a copy of the source workbook until it exists, or a new
+            # workbook for signal files
+            if os.path.exists(self.output_path):
+                wb = openpyxl.load_workbook(self.output_path)
+            elif is_signal_file(self.excel_path):
+                wb = openpyxl.Workbook()
+                wb.remove(wb.active)
+            else:
+                wb = openpyxl.load_workbook(self.excel_path)
+
+            for sheet_name, (df_maxima, df_minima) in self.tables.items():
+                ws = wb[sheet_name] if sheet_name in wb.sheetnames else wb.create_sheet(sheet_name)
+                startcol = find_empty_column(ws)
+                logger.info(f"Putting maxima and minima of {sheet_name} at column No.{startcol}")
+                # same layout as append_df_to_excel(..., startrow=2): header on the 3rd row
+                write_df(ws, df_maxima, startrow=3, startcol=startcol + 1)
+                write_df(ws, df_minima, startrow=3, startcol=startcol + 3)
+                metadata = {"startcol": startcol, "maxima": len(df_maxima), "minima": len(df_minima)}
+                wb.custom_doc_props.append(StringProperty(name=self.METADATA_PREFIX + sheet_name, value=json.dumps(metadata)))
+
+            wb.save(self.output_path)
+        logger.info(f"Saved peaks of {len(self.tables)} sheets to {self.output_path}")
+        self.processed.update(self.tables)
+        self.tables = {}
+
+
+def find_empty_column(ws):
+    # 0-based index of the first column whose header cells (first 3 rows) are
+    # empty, or one column after the data if there is none
+    n_columns = ws.max_column
+    header = list(ws.iter_rows(min_row=1, max_row=3, max_col=n_columns, values_only=True))
+    for i in range(n_columns):
+        if all(row[i] is None for row in header):
+            return i
+    return n_columns + 1
+
+
+def write_df(ws, df, startrow, startcol):
+    # startrow and startcol are 1-based, like openpyxl cells
+    for j, column in enumerate(df.columns):
+        ws.cell(row=startrow, column=startcol + j, value=column)
+    for i, row in enumerate(df.itertuples(index=False, name=None), start=startrow + 1):
+        for j, value in enumerate(row):
+            ws.cell(row=i, column=startcol + j, value=value.item() if hasattr(value, "item") else value)
+
+
+class TablePeakWriter():
+    """Write the peaks of every sheet to its own Parquet, Arrow IPC or CSV file.
+
+    Each file holds one row per peak (kind, x, y), sorted by kind and x, next to
+    the plots in ``output_dir/<workbook>/``. The metadata of the signal is
+    stored in the schema (key ``peakfinder``) for Parquet and Arrow, and in a
+    JSON file next to the table for CSV. Parquet and Arrow need pyarrow.
+    """
+    EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow", "csv": ".csv"}
+
+    def __init__(self, excel_path, output_dir, fmt):
+        if fmt not in self.EXTENSIONS:
+            raise ValueError(f"Unknown output format {fmt!r}, expected one of {list(self.EXTENSIONS)}")
+        self.excel_path = excel_path
+        self.output_dir = output_dir
+        self.fmt = fmt
+
+    def output_path(self, sheet_name):
+        name = os.path.basename(self.excel_path).split(".")[0]
+        return os.path.join(self.output_dir, name, f"{name}_{sheet_name}{self.EXTENSIONS[self.fmt]}")
+
+    def add(self, sheet_name, df_maxima, df_minima, metadata=None):
+        # every sheet has its own file, so it is written right away
+        output_path = self.output_path(sheet_name)
+        if os.path.exists(output_path):
+            logger.info(f"{output_path} already exists, skip saving")
+            return False
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+        metadata = dict(metadata or {})
+        metadata.setdefault("source", os.path.basename(self.excel_path))
+        metadata.setdefault("sheet", sheet_name)
+        df = peaks_table(df_maxima, df_minima)
+
+        with stage("table_write", format=self.fmt, rows=len(df)):
+            if self.fmt == "csv":
+                df.to_csv(output_path, index=False)
+                with open(os.path.splitext(output_path)[0] + ".json", "w") as f:
+                    json.dump(metadata, f, indent=4, default=str)
+            else:
+                try:
+                    import pyarrow as pa
+                    import pyarrow.parquet as pq
+                except ImportError:
+                    raise ImportError(f"Saving peaks as {self.fmt} requires pyarrow (pip install pyarrow)")
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                schema_metadata = dict(table.schema.metadata or {})
+                schema_metadata[b"peakfinder"] = json.dumps(metadata, default=str).encode()
+                table = table.replace_schema_metadata(schema_metadata)
+                if self.fmt == "parquet":
+                    pq.write_table(table, output_path)
+                else:
+                    with pa.OSFile(output_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                        writer.write_table(table)
+        logger.info(f"Saved peaks of {sheet_name} to {output_path}")
+        return True
+
+    def write(self):
+        # nothing is buffered, see add
+        pass
+
+
+PEAK_FORMATS = ["excel"] + list(TablePeakWriter.EXTENSIONS)
+
+
+def make_peak_writer(fmt, excel_path, output_dir):
+    if fmt == "excel":
+        name = os.path.splitext(os.path.basename(excel_path))[0] + ".xlsx"
+        return ExcelPeakWriter(excel_path, os.path.join(output_dir, name))
+    return TablePeakWriter(excel_path, output_dir, fmt)
+
+
+def peaks_table(df_maxima, df_minima):
+    # long format of the make_df tables: one (kind, x, y) row per peak
+    kind = pd.Categorical.from_codes(np.repeat([0, 1], [len(df_maxima), len(df_minima)]),
+                                     categories=["maxima", "minima"])
+    return pd.DataFrame({"kind": kind,
+                         "x": np.concatenate([df_maxima["X_maxima"].to_numpy(), df_minima["X_minima"].to_numpy()]).astype(np.int64),
+                         "y": np.concatenate([df_maxima["Y_maxima"].to_numpy(), df_minima["Y_minima"].to_numpy()]).astype(np.float64)})
+
+
+def save_peaks_to_excel(excel_path, output_path, sheet_name, df_maxima, df_minima):
+    # Write the peak tables of one sheet. Returns False if the sheet already holds peaks.
+    writer = ExcelPeakWriter(excel_path, output_path)
+    saved = writer.add(sheet_name, df_maxima, df_minima)
+    writer.write()
+    return saved
+
 ## DRAW PLOT ##
 
-def draw_plot(xvalues, yvalues, maxima, minima):
+PLOT_SIZE = (20, 10)
+PLOT_DPI = 300
+
+def envelope(xvalues, yvalues, n_bins):
+    # keep the first, last, smallest and largest sample of each of n_bins equal
+    # buckets, in order, so the line covers the same pixels as the full series;
+    # xvalues None stands for the sample numbers
+    yvalues = np.asarray(yvalues)
+    n_samples = len(yvalues)
+    if n_bins <= 0 or n_samples <= 4 * n_bins:
+        return get_coordinates(xvalues, np.arange(n_samples)), yvalues
+
+    size = -(-n_samples // n_bins)
+    n_full = n_samples // size * size
+    buckets = yvalues[:n_full].reshape(-1, size)
+    starts = np.arange(0, n_full, size)
+    positions = [starts, starts + size - 1, starts + buckets.argmin(axis=1), starts + buckets.argmax(axis=1)]
+    if n_full < n_samples:
+        tail = yvalues[n_full:]
+        positions.append([n_full, n_samples - 1, n_full + tail.argmin(), n_full + tail.argmax()])
+    positions = np.unique(np.concatenate(positions))
+    return get_coordinates(xvalues, positions), yvalues[positions]
+
+def draw_plot(xvalues, yvalues, maxima, minima, figsize=PLOT_SIZE, dpi=PLOT_DPI, max_bins=None, figure=None):
 
     xMaxima = get_coordinates(xvalues, maxima)
     yMaxima = get_coordinates(yvalues, maxima)
     xMinima = get_coordinates(xvalues, minima)
     yMinima = get_coordinates(yvalues, minima)
 
-    # Create figure and subplot
-    fig = Figure(figsize=(20, 10))
-    plot1 = fig.add_subplot(111)
+    with stage("plot", samples=len(yvalues)) as record:
+        # one bucket per horizontal pixel when saved at dpi, 0 plots every sample
+        if max_bins is None:
+            max_bins = int(figsize[0] * dpi)
+        xvalues, yvalues = envelope(xvalues, yvalues, max_bins)
+
+        # Create figure and subplot, on an Agg canvas so saving never needs Tk,
+        # or redraw the given figure from scratch
+        if figure is None:
+            fig = Figure(figsize=figsize)
+            FigureCanvasAgg(fig)
+        else:
+            fig = figure
+            fig.clear()
+            fig.set_size_inches(figsize)
+        plot1 = fig.add_subplot(111)
 
-    # Plot main data
-    plot1.plot(xvalues, yvalues, label='Data')
+        # Plot main data
+        plot1.plot(xvalues, yvalues, label='Data')
     
-    # Plot maxima points
-    plot1.plot(xMaxima, yMaxima, 'ro', label='Maxima')
+        # Plot maxima points
+        plot1.plot(xMaxima, yMaxima, 'ro', label='Maxima')
 
-    # Plot minima points
-    plot1.plot(xMinima, yMinima, 'bo', label='Minima')
+        # Plot minima points
+        plot1.plot(xMinima, yMinima, 'bo', label='Minima')
 
-    # Add a legend
-    plot1.legend()
+        # Add a legend
+        plot1.legend()
+        record["points"] = len(yvalues)
 
     return fig
 
 
+def save_pictures(figure, output_dir, name, sheet_name, dpi=PLOT_DPI):
+    dir_name = name.split(".")[0]
+    image_name = name.split(".")[0] + "_" + sheet_name + ".png"
+    output_path = os.path.join(output_dir, dir_name, image_name)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    if os.path.exists(output_path):
+        logger.info(f"{output_path} already exists, skip saving")
+        return output_path
+    with stage("png_save", dpi=dpi):
+        figure.savefig(output_path, dpi=dpi)
+    logger.info(f"Saved peaks plot to {output_path}")
+    return output_path
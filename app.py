@@ -8,14 +8,16 @@ from pathlib import Path
 from tqdm import tqdm
 import logging
 import threading
+import queue
 import time
 import numpy as np
-import openpyxl
 import json
-import shutil
 
 from Libs.utils import *
 from Libs.findpeaks import *
+from Libs.batch import PlotExporter, run_batch
+from Libs.cache import ResultCache
+from Libs.instrument import set_context
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -96,7 +98,7 @@ class App(customtkinter.CTk):
         super().__init__()
         # setup geometry
         window_width = 500
-        window_height = 800
+        window_height = 880
         self.geometry(f"{window_width}x{window_height}+{int(self.winfo_screenwidth()/2 - window_width/2)}+{int(self.winfo_screenheight()/2 - window_height/2)}")
         self.title("File Manager")
 
@@ -106,7 +108,11 @@ class App(customtkinter.CTk):
         self.MAIN.place(anchor='c', relx=.5, rely=.5)
 
         self.name = None
+        self.session = None
+        # candidates of the loaded signal, rebuilt when another signal is loaded
+        self.peak_index = None
         self.output_dir = "Output"
+        self.cache_dir = "Cache"
         self.history = History()
         self.mode = "individual"
 
@@ -131,8 +137,12 @@ class App(customtkinter.CTk):
         self.minMaximaValue = Parameters(self.MAIN, 3, "minMaximaValue", minMaximaValue)
         self.maxMaximaValue = Parameters(self.MAIN, 4, "maxMaximaValue", maxMaximaValue)
 
-        self.excludeOnEdges = customtkinter.CTkCheckBox(self.MAIN, text="excludeOnEdges")
-        self.excludeOnEdges.grid(row=5, column=0, padx=20, pady=20, sticky='nswe')
+        self.EdgeModeLabel = customtkinter.CTkLabel(self.MAIN, text="Edge mode")
+        self.EdgeModeLabel.grid(row=5, column=0, padx=20, pady=20, sticky='nswe')
+
+        self.EdgeModeOption = customtkinter.CTkOptionMenu(self.MAIN, values=list(EDGE_MODES))
+        self.EdgeModeOption.grid(row=5, column=1, padx=20, pady=20, sticky='nswe')
+        self.EdgeModeOption.set("include")
 
         # Widget 2: A drop down list to select the columns inside the excel file, only visible after loading the excel file
         self.ColumnLabel = customtkinter.CTkLabel(self.MAIN, 
@@ -150,6 +160,17 @@ class App(customtkinter.CTk):
         self.SheetOption = customtkinter.CTkOptionMenu(self.MAIN, state="readonly")
         self.SheetOption.grid(row=7, column=1, padx=20, pady=20, sticky='nswe')
 
+        # Number of worker processes used for "All Sheets"
+        self.WorkersEntry = Parameters(self.MAIN, 8, "Workers", os.cpu_count() or 1)
+
+        # Output format of the peaks, see make_peak_writer (parquet and arrow need pyarrow)
+        self.FormatLabel = customtkinter.CTkLabel(self.MAIN, text="Output format")
+        self.FormatLabel.grid(row=9, column=0, padx=20, pady=20, sticky='nswe')
+
+        self.FormatOption = customtkinter.CTkOptionMenu(self.MAIN, values=PEAK_FORMATS)
+        self.FormatOption.grid(row=9, column=1, padx=20, pady=20, sticky='nswe')
+        self.FormatOption.set("excel")
+
         # Widget 4: A button to Find Peaks, only visible after loading the excel file
         self.btn_find_peaks = customtkinter.CTkButton(self.MAIN, 
                                                       text="Find Peaks", 
@@ -183,6 +204,13 @@ class App(customtkinter.CTk):
 
         return progress_bar
 
+    def progress_reporter(self, progress_bar, updates=100, interval=0.1):
+        # coarse, throttled updates so the Tk redraw stays out of the detection loop
+        def callback(fraction):
+            progress_bar['value'] = fraction * 100
+            progress_bar.update()
+        return ProgressReporter(callback, updates=updates, interval=interval)
+
 
     def preprocess(self, value = None, sheet_name = None):
         print(f"Column selected: {self.ColumnOption.get()}")
@@ -214,53 +242,62 @@ class App(customtkinter.CTk):
 
         # Load data according to the sheet & column selected
         try:
-            self.df = read_clean_excel(self.excel_path, sheet_name=self.sheet_name)
+            # a float64 column of the sheet, or a memory map for signal files
+            self.yvalues = self.session.signal(column_name, self.sheet_name)
+            self.peak_index = None
         except Exception as e:
             logger.error(e)
             # use tkinter to show message box
             tk.messagebox.showerror("Error", "Excel file was not loaded!")
             return
 
-        self.yvalues = self.df[column_name].values
         if len(self.yvalues) > 0:
-            self.yvalues = np.array(self.yvalues, dtype=np.float64)
             logger.info(f"Loaded data ! Number of data points: {len(self.yvalues)}")
         else:
             logger.info("Selected column is empty !")
         
-        # set value of self.tolerance to
-        tolerance = np.std(self.yvalues)
+        # propose a tolerance, from the prominences of the candidate peaks that
+        # find_peaks then reuses through the index
+        self.peak_index = PeakIndex(self.yvalues)
+        tolerance = estimate_tolerance(self.yvalues, index=self.peak_index)
+        _, n_peaks = tolerance_curve(self.yvalues, [tolerance], index=self.peak_index)
+        logger.info(f"Proposed tolerance: {tolerance} ({n_peaks[0]} maxima)")
         self.ToleranceEntry.set(tolerance)
 
     def load_excel_file(self):
 
-        self.excel_path = tk.filedialog.askopenfilename(initialdir=os.getcwd(), title="Select Excel File", filetypes=(("Excel Files", "*.xlsx"), ("All Files", "*.*")))
+        signal_files = " ".join("*" + extension for extension in SIGNAL_EXTENSIONS)
+        self.excel_path = tk.filedialog.askopenfilename(initialdir=os.getcwd(), title="Select Excel File", filetypes=(("Excel Files", "*.xlsx"), ("Signal Files", signal_files), ("All Files", "*.*")))
         if self.excel_path:
             logger.info(f"Loading {self.excel_path}")
             self.name = Path(self.excel_path).name
-            self.df = read_clean_excel(self.excel_path)
-            self.columns = self.df.columns
-            self.output_path = os.path.join(self.output_dir, self.name)
+            # keep the workbook open and its parsed sheets cached while it is loaded,
+            # signal files (float64, one column if raw) are memory-mapped instead
+            if self.session is not None:
+                self.session.close()
+            self.session = open_session(self.excel_path)
+            self.columns = self.session.columns()
+            self.output_path = os.path.join(self.output_dir, Path(self.excel_path).stem + ".xlsx")
             logger.info(f"Columns in the excel file: {self.columns}")
 
-            try:
-                os.startfile(self.excel_path)
-            except:
-                pass
+            if not is_signal_file(self.excel_path):
+                try:
+                    os.startfile(self.excel_path)
+                except:
+                    pass
 
             self.ColumnOption.configure(values=self.columns)
             column_init = self.history.most_selected("column", self.columns)
             self.ColumnOption.set(column_init)
 
-            wb = openpyxl.load_workbook(self.excel_path)
-            self.sheet_names = wb.sheetnames
+            self.sheet_names = self.session.sheet_names
             self.SheetOption.configure(values=["All Sheets"] + self.sheet_names)
             self.sheet_name = self.sheet_names[0]
             self.SheetOption.set(self.sheet_name)
 
             self.preprocess()
 
-            self.btn_find_peaks.grid(row=9, columnspan=2, padx=20, pady=20, sticky='nswe')
+            self.btn_find_peaks.grid(row=10, columnspan=2, padx=20, pady=20, sticky='nswe')
             # set value of self.tolerance to the value
 
     def find_peaks_thread(self):
@@ -275,60 +312,141 @@ class App(customtkinter.CTk):
         elif self.mode == "batch":
             print("Batch mode !")
             logger.info("Batch mode !")
-            batch_progress_bar = self.create_progress_window()
-
-            for i, sheet_name in enumerate(self.sheet_names):
-                batch_progress_bar['value'] = (i+1)/len(self.sheet_names) * 100
-                batch_progress_bar.update()
-
-                self.sheet_name = sheet_name
+            column_name = self.ColumnOption.get()
+            self.history.add("column", column_name)
 
-                thread = threading.Thread(target=self.find_and_save(sheet_name))
-                thread.start()
+            params = self.get_parameters()
+            # every sheet uses the tolerance proposed for its own column, as preprocess does
+            params["tolerance"] = None
+            params["tolerance_method"] = "prominence"
+            max_workers = int(self.WorkersEntry.get())
+            fmt = self.FormatOption.get()
 
-            batch_progress_bar.master.destroy()
-            # Display a messagebox
-            tk.messagebox.showinfo("Analysis completed", f"Analyzed file is saved in {self.output_dir}")
+            batch_progress_bar = self.create_progress_window()
+            self.batch_queue = queue.Queue()
+            # the batch reads the selected column and sheet list until poll_batch sees it end
+            self.set_batch_running(True)
+
+            # the process pool is driven from a background thread and reports back
+            # through batch_queue, which poll_batch drains on the Tk mainloop
+            thread = threading.Thread(target=self.run_batch, args=(column_name, params, max_workers, fmt),
+                                      daemon=True)
+            thread.start()
+            self.after(100, self.poll_batch, batch_progress_bar)
                 
         else:
             logger.error("Mode not recognized !")
 
-    def find_and_save(self, sheet_name):
-        self.preprocess(sheet_name = sheet_name)
-        self.find_peaks()
-        self.save_peaks()
-        self.draw_peaks(mode="save")
-        logger.info(f"Finished finding & saving peaks of {sheet_name} !")
-
-    def find_peaks(self):
+    def run_batch(self, column_name, params, max_workers, fmt="excel"):
+        jobs = [(self.excel_path, sheet_name) for sheet_name in self.sheet_names]
+        progress = ProgressReporter(lambda fraction: self.batch_queue.put(("progress", fraction)))
+        # every exit posts "done" or "error", which poll_batch waits for to
+        # close the progress window and enable the controls again
+        try:
+            # Excel output gets all sheets with a single save at the end
+            self.peak_writer = make_peak_writer(fmt, self.excel_path, self.output_dir)
+            # plots are rendered in their own process pool while the next sheets are analyzed
+            self.plot_exporter = PlotExporter(self.output_dir)
+            with self.plot_exporter:
+                results, failed = run_batch(jobs, column_name, params, max_workers, progress=progress, on_result=self.save_result,
+                                            cache=ResultCache(self.cache_dir))
+                self.peak_writer.write()
+                failed += self.plot_exporter.close()
+        except Exception as e:
+            logger.error(e)
+            self.batch_queue.put(("error", e))
+            return
+        self.batch_queue.put(("done", failed))
 
-        # self.history.add("sheet", sheet_name)
-        column_name = self.ColumnOption.get()
-        self.history.add("column", column_name)
+    def poll_batch(self, batch_progress_bar):
+        while True:
+            try:
+                event, value = self.batch_queue.get_nowait()
+            except queue.Empty:
+                break
+            if event == "progress":
+                batch_progress_bar['value'] = value * 100
+                continue
+            batch_progress_bar.master.destroy()
+            self.set_batch_running(False)
+            if event == "error":
+                tk.messagebox.showerror("Error", f"Batch analysis failed: {value}")
+            elif value:
+                failed_sheets = ", ".join(sheet_name for _, sheet_name, _ in value)
+                tk.messagebox.showwarning("Analysis completed", f"Analyzed file is saved in {self.output_dir}\nFailed sheets: {failed_sheets}")
+            else:
+                # Display a messagebox
+                tk.messagebox.showinfo("Analysis completed", f"Analyzed file is saved in {self.output_dir}")
+            return
+        self.after(100, self.poll_batch, batch_progress_bar)
+
+    def set_batch_running(self, running):
+        state = "disabled" if running else "normal"
+        # loading another file would close the session the batch still reads
+        self.btn_load.configure(state=state)
+        self.btn_find_peaks.configure(state=state)
+        self.SheetOption.configure(state=state)
+        self.ColumnOption.configure(state=state)
+
+    def save_result(self, result):
+        # called by run_batch for every finished sheet, in the batch thread, so
+        # it only works on the result and leaves the sheet shown in the GUI alone
+        sheet_name = result["sheet_name"]
+        yvalues = result["yvalues"]
+        peaks = result["peaks"]
+        set_context(file=self.name, sheet=sheet_name)
+        logger.info(f"tolerance used for {sheet_name}: {result['tolerance']}")
+        df_maxima, df_minima = make_df(None, yvalues, peaks.maxima, peaks.minima)
+        if len(df_maxima) > 0 and len(df_minima) > 0:
+            logger.info(f"Found {len(df_maxima)} maxima and {len(df_minima)} minima")
+            metadata = {"source": self.name,
+                        "sheet": sheet_name,
+                        "column": result["column_name"],
+                        "tolerance": float(result["tolerance"]),
+                        "n_samples": len(yvalues)}
+            self.peak_writer.add(sheet_name, df_maxima, df_minima, metadata)
+        else:
+            logger.info("No peaks found")
+        self.plot_exporter.submit(result)
+        logger.info(f"Finished finding & saving peaks of {sheet_name} !")
 
+    def get_parameters(self):
         tolerance = float(self.ToleranceEntry.get())
         minPeakDistance = float(self.minPeakDistance.get())
         minMaximaValue = np.nan if self.minMaximaValue.get() == "NaN" or self.minMaximaValue.get() == "" else float(self.minMaximaValue.get())
         maxMaximaValue = np.nan if self.maxMaximaValue.get() == "NaN" or self.maxMaximaValue.get() == "" else float(self.maxMaximaValue.get())
-        excludeOnEdges = self.excludeOnEdges.get()
+        edge_mode = self.EdgeModeOption.get()
 
         logger.info(f"tolerance: {tolerance}")
         logger.info(f"minPeakDistance: {minPeakDistance}")
         logger.info(f"minMaximaValue: {minMaximaValue}")
         logger.info(f"maxMaximaValue: {maxMaximaValue}")
-        logger.info(f"excludeOnEdges: {excludeOnEdges}")
+        logger.info(f"edge_mode: {edge_mode}")
 
+        return {"tolerance": tolerance,
+                "minPeakDistance": minPeakDistance,
+                "minMaximaValue": minMaximaValue,
+                "maxMaximaValue": maxMaximaValue,
+                "engine": "numpy",
+                "edge_mode": edge_mode}
+
+    def find_peaks(self):
+
+        # self.history.add("sheet", sheet_name)
+        column_name = self.ColumnOption.get()
+        self.history.add("column", column_name)
+
+        params = self.get_parameters()
 
         progress_bar = self.create_progress_window(title=self.sheet_name, text="Finding peaks ...")
 
-        # find peaks
-        xvalues, yvalues, maxima, minima = PeakFinder(progress_bar,
-                                                      self.yvalues, 
-                                                      tolerance,
-                                                      minPeakDistance, 
-                                                      minMaximaValue, 
-                                                      maxMaximaValue, 
-                                                      excludeOnEdges)
+        # find peaks, only filtering the candidates again when just the parameters changed
+        if self.peak_index is None:
+            self.peak_index = PeakIndex(self.yvalues)
+        xvalues, yvalues, maxima, minima = PeakFinder(self.yvalues, 
+                                                      progress=self.progress_reporter(progress_bar),
+                                                      index=self.peak_index,
+                                                      **params)
 
         self.xvalues = xvalues
         self.yvalues = yvalues
@@ -337,8 +455,8 @@ class App(customtkinter.CTk):
 
         if len(self.maxima) > 0 and len(self.minima) > 0:
             logger.info(f"Found {len(self.maxima)} maxima and {len(self.minima)} minima")
-            self.btn_save_peaks.grid(row=10, column=0, padx=20, pady=20, sticky='nswe')
-            self.btn_draw_peaks.grid(row=10, column=1, padx=20, pady=20, sticky='nswe')
+            self.btn_save_peaks.grid(row=11, column=0, padx=20, pady=20, sticky='nswe')
+            self.btn_draw_peaks.grid(row=11, column=1, padx=20, pady=20, sticky='nswe')
         else:
             logger.info("No peaks found")
             return
@@ -363,47 +481,19 @@ class App(customtkinter.CTk):
                 logger.info("No peaks found")
                 return
             
-            # save the dataframe to 2 sheets named maxima and minima of an excel file
+            # save the dataframes in the selected format, see make_peak_writer
             print("Saving peaks ...")
-            output_path = self.output_path
-            logger.info(f"Saving peaks at {output_path}, sheet name: {self.sheet_name}...")
-
-            # Copy the original excel file to the output directory
-            if not os.path.exists(output_path):
-                shutil.copy(self.excel_path, output_path)
-                logger.info(f"First time analysis, cloned {self.name} to {self.output_dir}")
-            else:
-                # open self.sheet_name
-                temp_df = read_clean_excel(output_path, sheet_name=self.sheet_name)
-                # if the all "xMaxima", "yMaxima", "xMinima", "yMinima" columns exist, skip
-                processed = False
-                for i, temp_column in enumerate(temp_df.columns):
-                    if ("y_maxima" in temp_column.lower()) or ("minima" in temp_column.lower()):
-                        processed = True
-                    if temp_column == "":
-                        startcol = i
-                        logger.info(f"Found empty column at column No.{startcol} reserved putting maxima and minima")
-                        break
-                if processed:
-                    logger.info(f"Found maxima and minima columns in {self.sheet_name}, skip saving")
-                    return
+            fmt = self.FormatOption.get()
+            logger.info(f"Saving peaks as {fmt} in {self.output_dir}, sheet name: {self.sheet_name}...")
 
-            try:
-                append_df_to_excel(output_path, df_maxima, sheet_name=self.sheet_name, index=False, startrow=2, startcol=startcol)
-                logger.info(f"Saved maxima to sheet {self.sheet_name} of {output_path}")
-            except Exception as e:
-                print(e)
-                logger.info(f"Failed to save maxima to sheet {self.sheet_name} of {output_path}")
-                logger.info(e)
-
-            try:
-                append_df_to_excel(output_path, df_minima, sheet_name=self.sheet_name, index=False, startrow=2, startcol=startcol+2)
-                logger.info(f"Saved minima to sheet {self.sheet_name} of {output_path}")
-            # except as e, print e
-            except Exception as e:
-                print(e)
-                logger.info(f"Failed to save minima to sheet {self.sheet_name} of {output_path}")
-                logger.info(e)
+            metadata = {"source": self.name,
+                        "sheet": self.sheet_name,
+                        "column": self.ColumnOption.get(),
+                        "tolerance": float(self.ToleranceEntry.get()),
+                        "n_samples": len(self.yvalues)}
+            writer = make_peak_writer(fmt, self.excel_path, self.output_dir)
+            writer.add(self.sheet_name, df_maxima, df_minima, metadata)
+            writer.write()
 
 
     def draw_peaks(self, mode="display"):
@@ -431,15 +521,7 @@ class App(customtkinter.CTk):
             self.save_pictures(figure)
 
     def save_pictures(self, figure):
-        dir_name = self.name.split(".")[0]
-        image_name = self.name.split(".")[0] + "_" + self.sheet_name + ".png"
-        output_path = os.path.join(self.output_dir, dir_name, image_name)
-        Path(output_path).parent.mkdir(parents=True, exist_ok=True)
-        if os.path.exists(output_path):
-            logger.info(f"{output_path} already exists, skip saving")
-            return
-        figure.savefig(output_path, dpi=300)
-        logger.info(f"Saved peaks plot to {output_path}")
+        save_pictures(figure, self.output_dir, self.name, self.sheet_name)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+"""Headless batch runner, an alternative to the GUI in app.py.
+
+    python -m peakfinder run --input Data/ --column "Heart Volume_(pL/beat)" --tolerance 20
+
+Every sheet of every workbook found in --input is analyzed in a process pool
+and the peaks are saved like the GUI does: into a copy of the workbook in
+--output, plus optional plots. .npy and raw binary signal files are read
+through memory maps, --column then being the column number. tkinter is never
+imported.
+"""
+import argparse
+import logging
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from Libs.utils import PEAK_FORMATS, PLOT_DPI, PLOT_SIZE, SIGNAL_EXTENSIONS, make_peak_writer, make_df, open_session
+from Libs.findpeaks import EDGE_MODES, ENGINES, TOLERANCE_METHODS, ProgressReporter
+from Libs.batch import PlotExporter, run_batch
+from Libs.cache import ResultCache
+from Libs.instrument import enable_trace, set_context, summarize
+
+
+logger = logging.getLogger("peakfinder")
+
+
+def find_workbooks(inputs):
+    paths = []
+    for item in inputs:
+        item = Path(item)
+        if item.is_dir():
+            # skip the lock files Excel leaves next to open workbooks
+            paths.extend(sorted(p for p in item.iterdir()
+                                if p.suffix.lower() in [".xlsx"] + SIGNAL_EXTENSIONS and not p.name.startswith("~$")))
+        else:
+            paths.append(item)
+    return paths
+
+
+def list_sheets(excel_path, sheet_names=None, signal_options=None):
+    with open_session(excel_path, **(signal_options or {})) as session:
+        available = session.sheet_names
+    if sheet_names:
+        return [sheet_name for sheet_name in available if sheet_name in sheet_names]
+    return [sheet_name for sheet_name in available if "summary" not in sheet_name.lower()]
+
+
+def save_result(result, output_dir, formats, writers, exporter=None):
+    excel_path = result["excel_path"]
+    name = Path(excel_path).name
+    sheet_name = result["sheet_name"]
+    yvalues = result["yvalues"]
+    set_context(file=name, sheet=sheet_name)
+
+    # the x values are the sample numbers, which make_df uses for None
+    df_maxima, df_minima = make_df(None, yvalues, result["peaks"].maxima, result["peaks"].minima)
+    if len(df_maxima) == 0 or len(df_minima) == 0:
+        logger.info(f"No peaks found in sheet {sheet_name} of {name}")
+        return
+
+    metadata = {"source": name,
+                "sheet": sheet_name,
+                "column": result["column_name"],
+                "tolerance": float(result["tolerance"]),
+                "n_samples": len(yvalues)}
+    # one writer per workbook and format; Excel ones are saved once after the batch
+    for fmt in formats:
+        if (excel_path, fmt) not in writers:
+            writers[(excel_path, fmt)] = make_peak_writer(fmt, excel_path, output_dir)
+        writers[(excel_path, fmt)].add(sheet_name, df_maxima, df_minima, metadata)
+    if exporter is not None:
+        exporter.submit(result)
+
+
+def run(args):
+    workbooks = find_workbooks(args.input)
+    if not workbooks:
+        logger.error(f"No workbooks found in {args.input}")
+        return 1
+
+    signal_options = {"dtype": np.dtype(args.dtype), "n_columns": args.n_columns, "offset": args.offset}
+    jobs = []
+    for excel_path in workbooks:
+        for sheet_name in list_sheets(excel_path, args.sheet, signal_options):
+            jobs.append((str(excel_path), sheet_name))
+    logger.info(f"Found {len(jobs)} sheets in {len(workbooks)} workbooks")
+
+    params = {"tolerance": args.tolerance,
+              "minPeakDistance": args.min_peak_distance,
+              "minMaximaValue": args.min_maxima_value,
+              "maxMaximaValue": args.max_maxima_value,
+              "engine": args.engine,
+              "edge_mode": args.edge_mode,
+              "tolerance_method": args.tolerance_method}
+
+    os.makedirs(args.output, exist_ok=True)
+    if args.trace:
+        # worker processes started from now on append to the same file
+        enable_trace(args.trace)
+    progress = ProgressReporter(lambda fraction: logger.info(f"Progress: {fraction:.0%}"), updates=len(jobs) or 1)
+    writers = {}
+    # plots are rendered by their own process pool while the next sheets are analyzed
+    exporter = PlotExporter(args.output, args.plot_workers, tuple(args.plot_size), args.plot_dpi,
+                            signal_options) if args.plots else None
+    # peaks of the signals analyzed with the same parameters before are read from the cache
+    cache = None if args.no_cache else ResultCache(args.cache, int(args.cache_size * 2**20))
+    results, failed = run_batch(jobs, args.column, params, args.workers, progress=progress,
+                                on_result=lambda result: save_result(result, args.output, args.format, writers, exporter),
+                                signal_options=signal_options, cache=cache)
+    for writer in writers.values():
+        writer.write()
+    if exporter is not None:
+        failed += exporter.close()
+
+    logger.info(f"Analyzed {len(results)} sheets, {len(failed)} failed, output saved in {args.output}")
+    if args.trace and os.path.exists(args.trace):
+        for name, stages in summarize(args.trace).items():
+            logger.info(f"{name}: " + ", ".join(f"{stage_name} {total['wall']:.3f}s ({total['count']}x)"
+                                                 for stage_name, total in stages.items()))
+    for excel_path, sheet_name, error in failed:
+        logger.error(f"{excel_path} [{sheet_name}]: {error}")
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="peakfinder", description="Find maxima and minima of signals stored in Excel workbooks.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="analyze every sheet of the given workbooks")
+    run_parser.add_argument("--input", nargs="+", required=True,
+                            help=f"workbooks, signal files ({' '.join(SIGNAL_EXTENSIONS)}) or directories containing them")
+    run_parser.add_argument("--column", required=True, help="column holding the signal, as shown in the GUI (0, 1, ... for signal files)")
+    run_parser.add_argument("--sheet", nargs="+", help="only analyze these sheets (default: all but summary sheets)")
+    run_parser.add_argument("--tolerance", type=float, default=None, help="default: estimated on each signal, see --tolerance-method")
+    run_parser.add_argument("--tolerance-method", choices=TOLERANCE_METHODS, default="std",
+                            help="estimate used without --tolerance (default: std, the standard deviation of the signal)")
+    run_parser.add_argument("--dtype", default="float64", help="sample type of raw binary files (default: float64)")
+    run_parser.add_argument("--n-columns", type=int, default=1, help="interleaved columns of raw binary files (default: 1)")
+    run_parser.add_argument("--offset", type=int, default=0, help="header bytes to skip in raw binary files (default: 0)")
+    run_parser.add_argument("--min-peak-distance", type=float, default=0)
+    run_parser.add_argument("--min-maxima-value", type=float, default=np.nan)
+    run_parser.add_argument("--max-maxima-value", type=float, default=np.nan)
+    run_parser.add_argument("--edge-mode", choices=list(EDGE_MODES), default="include")
+    run_parser.add_argument("--engine", choices=ENGINES, default="numpy")
+    run_parser.add_argument("--workers", type=int, default=None, help="worker processes (default: number of CPUs)")
+    run_parser.add_argument("--output", default="Output", help="output directory (default: Output)")
+    run_parser.add_argument("--cache", default="Cache", help="directory of the result cache (default: Cache)")
+    run_parser.add_argument("--cache-size", type=float, default=512, help="size limit of the result cache in MB (default: 512)")
+    run_parser.add_argument("--no-cache", action="store_true", help="always run the detection")
+    run_parser.add_argument("--trace", help="append per-stage timings and memory to this JSON lines file")
+    run_parser.add_argument("--format", nargs="+", choices=PEAK_FORMATS, default=["excel"],
+                            help="peak output formats (default: excel); parquet and arrow need pyarrow")
+    run_parser.add_argument("--plots", action="store_true", help="also save a PNG plot of every sheet")
+    run_parser.add_argument("--plot-size", type=float, nargs=2, default=PLOT_SIZE, metavar=("WIDTH", "HEIGHT"),
+                            help=f"plot size in inches (default: {PLOT_SIZE[0]} {PLOT_SIZE[1]})")
+    run_parser.add_argument("--plot-dpi", type=int, default=PLOT_DPI, help=f"plot resolution (default: {PLOT_DPI})")
+    run_parser.add_argument("--plot-workers", type=int, default=None, help="plot export processes (default: half the CPUs)")
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(name)s:%(message)s')
+
+    if args.command == "run":
+        return run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())